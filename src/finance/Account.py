@@ -1,18 +1,21 @@
 
 import os, sys
+import bisect
 
-import pandas
+import numpy
 import datetime
+from typing import Callable
 
 from GlobalEnv import GlobalEnv
 from helpers import percentageDifference
 from utils.stringcompare import compareStrings
 
-from Transaction import Transaction
+from Transaction import Transaction, Currency
+from finance.TransactionTable import TransactionTable
 
 class Account:
 
-    def __init__(self, name: str, currency: str, transactions: list[Transaction], maxPercentageFee: int = 15, similarityConfidance: int = 60):
+    def __init__(self, name: str, currency: str, transactions: list[Transaction] | TransactionTable, maxPercentageFee: int = 15, similarityConfidance: int = 60, presorted: bool = False):
 
         if GlobalEnv().loggingEnabled:
             print(f'Creating account... ({name} in {currency} - ', end='', flush=True, file=sys.stderr)
@@ -24,15 +27,20 @@ class Account:
 
         assert len(transactions) >= 0, '\nAccount must have at least one transaction'
 
-        self.transactions = list(transactions)
+        if not isinstance(transactions, TransactionTable):
+            transactions = TransactionTable.fromTransactions(list(transactions))
+
+        self.table: TransactionTable = transactions
 
         self.currency = currency
         self.convertToCurrency(self.currency)
 
-        self.sortByDate()
+        self.newestFirst: bool = True
+        if not presorted: # already newest first, ex: merged by a portfolio query
+            self.sortByDate(self.newestFirst)
 
         if GlobalEnv().loggingEnabled:
-            print(f'{len(self.transactions)} transactions)', flush=True, file=sys.stderr)
+            print(f'{len(self.table)} transactions)', flush=True, file=sys.stderr)
 
     # hash operator for the set
     def __hash__(self):
@@ -47,55 +55,79 @@ class Account:
         # compare hashes
         return hash(self) == hash(other)
 
+    # row views over the columnar table, for callers that work with Transaction objects
+    @property
+    def transactions(self) -> list[Transaction]:
+        return self.table.toTransactions()
+
+    @transactions.setter
+    def transactions(self, transactions: list[Transaction]):
+
+        self.table = TransactionTable.fromTransactions(transactions)
+        self.sortByDate(self.newestFirst)
+
     def sortByDate(self, newestFirst: bool = True):
-        self.transactions.sort(reverse=newestFirst)
 
-    def convertToCurrency(self, targetCurrency: str):
-        [t.convertToCurrency(targetCurrency) for t in self.transactions]
+        self.table = self.table.sortByDate(newestFirst)
+        self.newestFirst = newestFirst
+
+    def dateRange(self, dateLowerBound: datetime.date = None, dateUpperBound: datetime.date = None) -> TransactionTable:
+        # the table is kept sorted by date, so this is a binary search and a slice
+        return self.table.take(self.table.dateSlice(dateLowerBound, dateUpperBound, self.newestFirst))
 
-    def toDataFrame(self) -> pandas.DataFrame:
+    def balances(self, calendar: numpy.ndarray) -> numpy.ndarray:
 
-        print(f'Converting account to dataframe...', flush=True, file=sys.stderr)
+        # reported balance at the end of each calendar day (minor units), carried forward from the
+        # latest transaction on or before it: one binary search per day over the sorted dates
+        if len(self.table) == 0:
+            return numpy.zeros(len(calendar), dtype=numpy.int64)
 
-        data: list[pandas.DataFrame] = []
-        for t in self.transactions:
-            t.account = self.name
-            data.append(t.toDataFrameRow())
+        dates = self.table.date[::-1] if self.newestFirst else self.table.date
+        balance = self.table.balance[::-1] if self.newestFirst else self.table.balance
 
-        return pandas.DataFrame(data)
+        latest = numpy.searchsorted(dates, calendar, side='right') - 1
+        return numpy.where(latest >= 0, balance[numpy.maximum(latest, 0)], 0)
 
-    def _findInitialTransaction(self, start: int) -> int:
+    def balanceOn(self, date: datetime.date) -> float:
+        return int(self.balances(numpy.array([date], dtype='datetime64[D]'))[0]) / Currency.scale(self.currency)
 
-        refTransaction = self.transactions[start]
+    def convertToCurrency(self, targetCurrency: str):
+        self.table.convertToCurrency(targetCurrency)
 
-        for i in range(start, len(self.transactions)):
-            candidate = self.transactions[i]
+    def _findInitialTransaction(self, start: int, credit: list[int], byAmount: dict[int, list[int]], similar: Callable[[int, int], bool]) -> int:
 
-            if candidate.credit + refTransaction.credit != 0:
-                continue
+        # rows with exactly the offsetting amount, in order, starting from this one
+        candidates = byAmount.get(-credit[start], [])
 
-            descriptionSimilarity: int = compareStrings(candidate.description, refTransaction.description)
-            if  descriptionSimilarity < self.similarityConfidance:
+        for i in candidates[bisect.bisect_left(candidates, start):]:
+
+            if not similar(i, start):
                 continue
 
             return i
 
         return -1
 
-    def _findTransactionWithFee(self, start: int) -> int:
+    def _findTransactionWithFee(self, start: int, credit: list[int], byAbsolute: numpy.ndarray, sortedAbsolute: numpy.ndarray, similar: Callable[[int, int], bool]) -> int:
 
-        refTransaction = self.transactions[start]
+        amount = abs(credit[start])
 
-        for i in range(start-1, -1, -1):
-            candidate = self.transactions[i]
+        # bigger amounts within maxPercentageFee of this one: (amount, amount * (200 + p) / (200 - p)]
+        high = len(sortedAbsolute)
+        if self.maxPercentageFee < 200:
+            bound = amount * (200 + self.maxPercentageFee) / (200 - self.maxPercentageFee) + 1
+            high = numpy.searchsorted(sortedAbsolute, bound, side='right')
 
-            if abs(candidate.credit) <= abs(refTransaction.credit):
-                continue
+        low = numpy.searchsorted(sortedAbsolute, amount, side='right')
+        candidates = byAbsolute[low:high]
 
-            if percentageDifference(abs(refTransaction.credit), abs(candidate.credit)) > self.maxPercentageFee:
+        # closest earlier row first
+        for i in sorted(candidates[candidates < start].tolist(), reverse=True):
+
+            if percentageDifference(amount, abs(credit[i])) > self.maxPercentageFee:
                 continue
 
-            if compareStrings(candidate.description, refTransaction.description) < self.similarityConfidance:
+            if not similar(i, start):
                 continue
 
             return i
@@ -105,63 +137,210 @@ class Account:
     def normalizeTransactionsWithFees(self):
 
         toRemove: set[int] = set()
+        credit: list[int] = self.table.credit.tolist() # minor units, offsetting amounts compare exactly
+
+        # exact amount -> row indices, for the offsetting transaction
+        byAmount: dict[int, list[int]] = {}
+        for i, amount in enumerate(credit):
+            byAmount.setdefault(amount, []).append(i)
+
+        # rows sorted by absolute amount, for the fee window
+        absolute = numpy.abs(self.table.credit)
+        byAbsolute = numpy.argsort(absolute, kind='stable')
+        sortedAbsolute = absolute[byAbsolute]
+
+        # description similarity, computed once per pair of distinct descriptions
+        descriptionCode: list[int] = self.table.descriptionCode.tolist()
+        similarities: dict[tuple[int, int], bool] = {}
+
+        def similar(i: int, j: int) -> bool:
 
-        for i, t in enumerate(self.transactions):
+            key = (min(descriptionCode[i], descriptionCode[j]), max(descriptionCode[i], descriptionCode[j]))
+            if key not in similarities:
+                similarity = compareStrings(self.table.descriptions[key[0]], self.table.descriptions[key[1]])
+                similarities[key] = similarity >= self.similarityConfidance
 
-            if t.credit <= 0:
+            return similarities[key]
+
+        for i in range(len(self.table)):
+
+            if credit[i] <= 0:
                 continue
 
-            initialTransactionIndex = self._findInitialTransaction(start=i)
+            initialTransactionIndex = self._findInitialTransaction(i, credit, byAmount, similar)
             if initialTransactionIndex == -1:
                 continue
 
-            transactionWithFeeIndex = self._findTransactionWithFee(start=i)
+            transactionWithFeeIndex = self._findTransactionWithFee(i, credit, byAbsolute, sortedAbsolute, similar)
             if transactionWithFeeIndex == -1:
                 continue
 
-            transactionWithFee: Transaction = self.transactions[transactionWithFeeIndex]
-            transactionWithFee.feePercentage = percentageDifference(abs(t.credit), abs(transactionWithFee.credit))
-            transactionWithFee.feeAmount = abs(t.credit) - abs(transactionWithFee.credit)
+            self.table.feePercentage[transactionWithFeeIndex] = percentageDifference(abs(credit[i]), abs(credit[transactionWithFeeIndex]))
+            self.table.feeAmount[transactionWithFeeIndex] = abs(credit[i]) - abs(credit[transactionWithFeeIndex])
 
             toRemove.add(initialTransactionIndex)
             toRemove.add(i)
 
-        for index in sorted(toRemove, reverse=True):
-            self.transactions.pop(index)
+        keep = numpy.ones(len(self.table), dtype=bool)
+        keep[list(toRemove)] = False
+        self.table = self.table.take(keep)
+
+    def merge(self, transactions: list[Transaction] | TransactionTable) -> tuple[int, int]:
+
+        if not isinstance(transactions, TransactionTable):
+            transactions = TransactionTable.fromTransactions(list(transactions))
+
+        if len(transactions) == 0:
+            return 0, 0
+
+        transactions.convertToCurrency(self.currency)
+        new = transactions.sortByDate(self.newestFirst) # only the new run gets sorted
+
+        # keys count repeated (uniqueId, date, description) rows apart, so a key only repeats for an updated row
+        latest: dict[int, int] = {key: j for j, key in enumerate(new.keys().tolist())}
+
+        # keys include the date, so existing rows can only share one inside the new run's date range
+        window = self.table.dateSlice(new.date.min(), new.date.max(), self.newestFirst)
+        existing: dict[int, int] = {key: window.start + i for i, key in enumerate(self.table.take(window).keys().tolist())}
+
+        updates = [(existing[key], j) for key, j in latest.items() if key in existing]
+        inserts = sorted(j for key, j in latest.items() if key not in existing)
+
+        # both runs on the same dictionaries
+        combined = TransactionTable.concat([self.table, new])
+        table = combined.take(slice(0, len(self.table)))
+        new = combined.take(slice(len(self.table), None))
+
+        # upsert rows that were already there and changed (ex: pending -> completed), the transfer pairing
+        # is left out of the comparison: it is matched again after every merge
+        if updates:
+            rows, sources = (numpy.array(indices) for indices in zip(*updates))
+
+            changed = numpy.zeros(len(rows), dtype=bool)
+            for column in TransactionTable.ArrayColumns:
+                if column != 'transferId':
+                    changed |= table.__getattribute__(column)[rows] != new.__getattribute__(column)[sources]
+
+            rows, sources = rows[changed], sources[changed]
+            for column in TransactionTable.ArrayColumns:
+                table.__getattribute__(column)[rows] = new.__getattribute__(column)[sources]
+
+            updates = list(zip(rows.tolist(), sources.tolist()))
 
-    def addTotal(self):
-        
-        if len(self.transactions) == 0:
-            return
+        # merge the sorted run of new rows into the sorted table, no full re-sort
+        new = new.take(numpy.array(inserts, dtype=numpy.int64))
+        self.table = table.insert(table.insertPositions(new, self.newestFirst), new)
 
-        total = Transaction(self.transactions[0].currency)
+        if GlobalEnv().loggingEnabled:
+            print(f'[INFO] Merged into {self.name}: {len(inserts)} new, {len(updates)} updated', file=sys.stderr)
+
+        return len(inserts), len(updates)
+
+    def reconcile(self, separateFees: bool = False) -> 'Reconciliation':
+
+        # chronological order, balances are reported after each transaction
+        order = self.table.sortOrder(newestFirst=False)
+        credit = self.table.credit[order]
+        balance = self.table.balance[order]
+
+        # separate fees are charged on top of the credit (Revolut), otherwise they are already part of it
+        delta = credit - self.table.feeAmount[order] if separateFees else credit
+
+        # every credit counts in the running sum, but only the balances the bank reported are compared:
+        # a filled in one (ex: a pending revolut row) is a copy of the previous one, not a checkpoint
+        reported = numpy.flatnonzero(self.table.balanceReported[order])
+        runningSum = numpy.cumsum(delta)[reported]
+        balance = balance[reported]
+
+        # expected running balance from the first reported one, in exact minor units
+        expected = balance[0] - runningSum[0] + runningSum if len(reported) else runningSum
+        drift = balance - expected
+
+        # a jump in the drift is money that moved without a transaction to explain it
+        step = numpy.zeros(len(order), dtype=numpy.int64)
+        step[reported] = numpy.diff(drift, prepend=0)
+
+        # two reported rows in the wrong order: each step is off but the pair adds up
+        swapped = numpy.zeros(len(order), dtype=bool)
+        if len(reported) > 2:
+            pairStart = (balance[2:] - balance[:-2] == runningSum[2:] - runningSum[:-2]) & (step[reported[1:-1]] != 0)
+            swapped[reported[1:-1]] |= pairStart
+            swapped[reported[2:]] |= pairStart
+
+        # the same transaction ingested more than once, every occurrence after the first: same key and same
+        # reported balance (distinct rows sharing a key, like two coffees in the same second, differ in balance)
+        keys = self.table.keys(occurrences=False).view(numpy.uint64) ^ (self.table.balance.view(numpy.uint64) * numpy.uint64(0xD6E8FEB86659FD93))
+        duplicate = numpy.ones(len(order), dtype=bool)
+        duplicate[numpy.unique(keys[order], return_index=True)[1]] = False
+
+        gaps = numpy.flatnonzero((step != 0) & ~swapped & ~duplicate)
+
+        return Reconciliation(self, order, step, gaps, numpy.flatnonzero(duplicate), numpy.flatnonzero(swapped))
+
+    def getTotal(self) -> Transaction:
+
+        if len(self.table) == 0:
+            return None
+
+        currency = self.table.currencies[self.table.currencyCode[0]]
+
+        total = Transaction(currency)
         total.balance = str()
         total.description = 'TOTAL'
         total.type = str('TOTAL')
 
-        for t in self.transactions:
-            total.credit += t.credit
-            total.feeAmount += t.feeAmount
+        # exact integer sums of minor units
+        total.credit = int(self.table.credit.sum()) / Currency.scale(currency)
+        total.feeAmount = int(self.table.feeAmount.sum()) / Currency.scale(currency)
 
-        self.transactions.append(total)
+        return total
 
-def cacheAccount(account: Account):
+class Reconciliation:
+
+    # rows are positions in the account's chronological order
+    def __init__(self, account: Account, order: numpy.ndarray, step: numpy.ndarray, gaps: numpy.ndarray, duplicates: numpy.ndarray, outOfOrder: numpy.ndarray):
+
+        self.account: Account = account
+        self.order: numpy.ndarray = order
+        self.step: numpy.ndarray = step
+
+        self.gaps: numpy.ndarray = gaps
+        self.duplicates: numpy.ndarray = duplicates
+        self.outOfOrder: numpy.ndarray = outOfOrder
+
+    def ok(self) -> bool:
+        return len(self.gaps) == 0 and len(self.duplicates) == 0 and len(self.outOfOrder) == 0
+
+    def _describe(self, position: int) -> str:
 
-    print(f'Caching {account.name} account with {len(account.transactions)} transactions...', end=' ', flush=True, file=sys.stderr)
+        t = self.account.table.row(int(self.order[position]))
+        return f'{t.date} #{t.uniqueId} {t.description}'
 
-    if len(account.transactions) == 0:
-        print('0 transactions to cache.', flush=True, file=sys.stderr)
+    def report(self, maxLines: int = 10) -> str:
+
+        scale = Currency.scale(self.account.currency)
+        lines = [f'{self.account.name}: {len(self.gaps)} gaps, {len(self.duplicates)} duplicates, {len(self.outOfOrder)} out of order']
+
+        lines += [f'  gap of {self.step[i] / scale:.2f} {self.account.currency} before {self._describe(i)}' for i in self.gaps[:maxLines]]
+        lines += [f'  duplicate {self._describe(i)}' for i in self.duplicates[:maxLines]]
+        lines += [f'  out of order {self._describe(i)}' for i in self.outOfOrder[:maxLines]]
+
+        return '\n'.join(lines)
+
+def cacheAccount(account: Account):
+
+    if len(account.table) == 0:
+        print(f'Caching {account.name} account... 0 transactions to cache.', flush=True, file=sys.stderr)
         return
 
-    # bank_audi.csv
+    # bank_audi.npz
     fileName: str = account.name.lower().replace(' ', '_')
-    fileName += '.csv'
+    fileName += '.npz'
 
     from finance.main import CACHE_DIR
-    csvFilePath = os.path.join(CACHE_DIR, fileName)
-    if os.path.exists(csvFilePath):
-        os.remove(csvFilePath)
+    cachePath = os.path.join(CACHE_DIR, fileName)
+
+    print(f'Caching {account.name} account with {len(account.table)} transactions... (to {cachePath})\n', end='', flush=True, file=sys.stderr)
 
-    print(f'(to {csvFilePath})', flush=True, file=sys.stderr)
-    dataFrame = account.toDataFrame()
-    dataFrame.to_csv(csvFilePath, index=False)
+    account.table = account.table.withAccountName(account.name)
+    account.table.save(cachePath) # replaces the previous cache in one rename
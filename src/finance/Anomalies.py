@@ -0,0 +1,136 @@
+import numpy
+from types import SimpleNamespace
+
+from finance.Transaction import Currency
+from finance.TransactionTable import TransactionTable
+from finance.Subscriptions import merchantCodes
+
+def _groupMedians(groups: numpy.ndarray, values: numpy.ndarray) -> numpy.ndarray:
+
+    # median of each group, read off one sort by (group, value): middle element(s) of each run
+    order = numpy.lexsort((values, groups))
+    sortedValues = values[order]
+
+    counts = numpy.bincount(groups)
+    starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+
+    present = counts > 0
+    medians = numpy.zeros(len(counts))
+    medians[present] = (sortedValues[starts[present] + (counts[present] - 1) // 2] + sortedValues[starts[present] + counts[present] // 2]) / 2
+
+    return medians
+
+_MaxBatchCells: int = 1 << 20 # values per padded window matrix
+
+def _paddedMedians(windows: numpy.ndarray, lengths: numpy.ndarray) -> numpy.ndarray:
+
+    # median of each row of a nan padded matrix, row i holding its values in its first lengths[i] columns
+    ordered = numpy.sort(windows, axis=1) # nan last
+    lower = numpy.take_along_axis(ordered, ((lengths - 1) // 2)[:, None], axis=1)[:, 0]
+    upper = numpy.take_along_axis(ordered, (lengths // 2)[:, None], axis=1)[:, 0]
+
+    return (lower + upper) / 2
+
+def _rollingStatistics(groups: numpy.ndarray, days: numpy.ndarray, values: numpy.ndarray, window: int, minCount: int) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+
+    # per row, over its group's trailing window of days (the row included): how many rows it holds, their median
+    # and their median absolute deviation from that median; windows under minCount rows are left at 0
+    order = numpy.lexsort((days, groups))
+    sortedDays = days[order].astype(numpy.int64)
+    sortedValues = values[order]
+
+    # (group, day) as one sorted integer, groups further apart than any window: each window starts with one binary search
+    span = int(sortedDays.max() - sortedDays.min()) + window + 1 if len(order) else 1
+    positions = groups[order].astype(numpy.int64) * span + (sortedDays - sortedDays.min(initial=0))
+    starts = numpy.searchsorted(positions, positions - window, side='right')
+    counts = numpy.arange(1, len(order) + 1) - starts
+
+    medians = numpy.zeros(len(order))
+    mads = numpy.zeros(len(order))
+
+    # windows as rows of a nan padded matrix, sorted once per batch: rows batched by window length
+    # (up to a power of two, the padding at most doubles them) and by size, to bound the matrix
+    rows = numpy.flatnonzero(counts >= minCount)
+    lengthClasses = numpy.ceil(numpy.log2(counts[rows])).astype(numpy.int64) if len(rows) else rows
+    for lengthClass in numpy.unique(lengthClasses).tolist():
+
+        width = 1 << lengthClass
+        classRows = rows[lengthClasses == lengthClass]
+
+        for batch in range(0, len(classRows), max(1, _MaxBatchCells // width)):
+
+            batchRows = classRows[batch:batch + max(1, _MaxBatchCells // width)]
+            lengths = counts[batchRows]
+
+            # row i's window, newest first: positions i, i - 1, ..., starts[i]
+            offsets = batchRows[:, None] - numpy.arange(width)[None, :]
+            inWindow = numpy.arange(width)[None, :] < lengths[:, None]
+            windows = numpy.where(inWindow, sortedValues[numpy.maximum(offsets, 0)], numpy.nan)
+
+            medians[batchRows] = _paddedMedians(windows, lengths)
+            mads[batchRows] = _paddedMedians(numpy.abs(windows - medians[batchRows][:, None]), lengths)
+
+    result = tuple(numpy.empty_like(column) for column in (counts, medians, mads))
+    for column, sortedColumn in zip(result, (counts, medians, mads)):
+        column[order] = sortedColumn
+
+    return result
+
+class Anomalies:
+
+    Threshold: float = 3.5 # robust z-score above which an amount is unusual
+    MinGroupSize: int = 5
+
+    # Transactions whose amount is unusual for their merchant (or their type, for merchants seen too rarely),
+    # robust z-scores from the group median and median absolute deviation
+    def __init__(self, table: TransactionTable, currency: str, window: int = None):
+
+        self.currency: str = currency
+        self.anomalies: list[SimpleNamespace] = []
+
+        if len(table) == 0:
+            return
+
+        amounts = table.credit.astype(numpy.float64)
+
+        merchantOfDescription = merchantCodes(table.descriptions)
+
+        # (type, merchant) groups, with the type alone as the fallback
+        typeGroups = table.typeCode.astype(numpy.int64)
+        merchantGroups = numpy.unique(typeGroups * (merchantOfDescription.max(initial=0) + 1) + merchantOfDescription[table.descriptionCode], return_inverse=True)[1]
+
+        scores = numpy.zeros(len(table))
+        usual = numpy.zeros(len(table))
+        decided = numpy.zeros(len(table), dtype=bool)
+
+        for groups in [merchantGroups, numpy.unique(typeGroups, return_inverse=True)[1]]:
+
+            if window:
+                counts, medians, mads = _rollingStatistics(groups, table.date, amounts, window, Anomalies.MinGroupSize)
+                deviations = numpy.abs(amounts - medians)
+            else:
+                counts = numpy.bincount(groups)[groups]
+                medians = _groupMedians(groups, amounts)[groups]
+                deviations = numpy.abs(amounts - medians)
+                mads = _groupMedians(groups, deviations)[groups]
+
+            # rows of big enough groups (or windows) are scored here, the others fall through to the next grouping
+            eligible = ~decided & (counts >= Anomalies.MinGroupSize) & (mads > 0)
+
+            scores[eligible] = 0.6745 * deviations[eligible] / mads[eligible]
+            usual[eligible] = medians[eligible]
+            decided |= eligible
+
+        scale = Currency.scale(currency)
+        for i in numpy.flatnonzero(scores > Anomalies.Threshold).tolist():
+
+            t = table.row(i)
+            self.anomalies.append(SimpleNamespace(
+                account=t.account,
+                description=t.description,
+                date=t.date,
+                type=t.type.name,
+                credit=t.credit,
+                usual=round(float(usual[i]) / scale, 2),
+                score=round(float(scores[i]), 1),
+            ))
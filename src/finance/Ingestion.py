@@ -0,0 +1,53 @@
+import os, sys
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+class AccountSource:
+
+    # Where an account comes from: its binary cache, and the statement a refresh parses into it
+    def __init__(self, name: str, currency: str, cacheFile: str, statementFile: str, parse: Callable, cpuBound: bool = False, normalizeFees: bool = False, separateFees: bool = False):
+
+        self.name: str = name
+        self.currency: str = currency
+
+        self.cacheFile: str = cacheFile
+        self.statementFile: str = statementFile
+
+        # parse(statementPath) -> list[Transaction], run in another process when cpuBound (pdf extraction)
+        self.parse: Callable = parse
+        self.cpuBound: bool = cpuBound
+
+        self.normalizeFees: bool = normalizeFees
+        self.separateFees: bool = separateFees # see Account.reconcile
+
+class Job:
+
+    def __init__(self, name: str, function: Callable, args: tuple = (), cpuBound: bool = False):
+
+        self.name: str = name
+        self.function: Callable = function
+        self.args: tuple = args
+        self.cpuBound: bool = cpuBound
+
+def runConcurrently(jobs: list[Job]) -> list[object]:
+
+    # cpu bound jobs in a process pool, the rest (csv reads and writes) in threads,
+    # results in job order whatever finishes first; a failing job prints its error and yields None
+    processPool = ProcessPoolExecutor(max_workers=min(sum(job.cpuBound for job in jobs), os.cpu_count() or 1)) if any(job.cpuBound for job in jobs) else None
+
+    results: list[object] = []
+    with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as threads:
+
+        futures = [(processPool if job.cpuBound else threads).submit(job.function, *job.args) for job in jobs]
+
+        for job, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f'[ERROR] {job.name}: {type(e).__name__}: {e}', flush=True, file=sys.stderr)
+                results.append(None)
+
+    if processPool is not None:
+        processPool.shutdown()
+
+    return results
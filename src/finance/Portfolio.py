@@ -1,6 +1,12 @@
 
+import numpy
+from types import SimpleNamespace
+
 from Account import Account
-from Transaction import Transaction, TransactionFilter
+from Transaction import TransactionFilter
+from finance.Transaction import Currency # the one holding the loaded rate history
+from finance.TransactionTable import TransactionTable
+from finance.QueryPlan import QueryPlan
 from datetime import datetime
 
 class Portfolio:
@@ -10,19 +16,17 @@ class Portfolio:
         self.accounts: set[Account] = set()
         self.currency: str = currency
 
-        emptyFilter = Transaction()
-        for attr in emptyFilter.__dict__.keys():
-            emptyFilter.__dict__[attr] = None
+        self.filter: TransactionFilter = TransactionFilter()
 
-        self.filter: Transaction = emptyFilter
+        self.limit: int = None
+        self.matched: int = 0 # rows matching the last build, before the limit
 
         self.dateLowerBound: datetime.date = datetime.strptime('01-01-1900', "%d-%m-%Y").date()
         self.dateUpperBound: datetime.date = datetime.strptime('01-01-2099', "%d-%m-%Y").date()
 
     def withAccount(self, account: Account):
 
-        account.convertToCurrency(self.currency)
-        self.accounts.add(account)
+        self.accounts.add(account) # converted once, in build
         return self
 
     def withFilter(self, filter: TransactionFilter):
@@ -52,23 +56,62 @@ class Portfolio:
         self.dateUpperBound = dateUpperBound
         return self
 
-    def build(self) -> Account:
-        
-        transactions: list[Transaction] = []
-        for account in self.accounts:
-            transactions.extend(account.transactions)
+    def netWorth(self, date: datetime.date = None) -> list[SimpleNamespace]:
+
+        accounts = sorted(self.accounts, key=lambda account: account.name)
+        if self.filter.account is not None:
+            accounts = [account for account in accounts if self.filter.account.lower() in account.name.lower()]
+
+        accounts = [account for account in accounts if len(account.table)]
+        if not accounts:
+            return []
+
+        # one shared calendar, newest day first, from the first transaction to the last one (or a single day)
+        if date is not None:
+            calendar = numpy.array([date], dtype='datetime64[D]')
+        else:
+            first = max(filter(None, [self.dateLowerBound, self.filter.dateLowerBound, min(account.table.date.min() for account in accounts)]))
+            last = min(filter(None, [self.dateUpperBound, self.filter.dateUpperBound, max(account.table.date.max() for account in accounts)]))
+            calendar = numpy.arange(numpy.datetime64(last, 'D'), numpy.datetime64(first, 'D') - 1, -1)
+
+        # each account forward filled onto the calendar, converted at each day's rate, in target minor units
+        scale = Currency.scale(self.currency)
+        columns: dict[str, numpy.ndarray] = {}
+        for account in accounts:
+
+            factors = Currency.table().ratesOn(account.currency, self.currency, calendar) * scale / Currency.scale(account.currency)
+            columns[account.name] = TransactionTable.toMinorUnits(account.balances(calendar), factors)
+
+        total = numpy.sum(list(columns.values()), axis=0)
 
-        transactions.sort(reverse=True)
+        rows: list[SimpleNamespace] = []
+        for i, day in enumerate(calendar.astype(object).tolist()):
 
-        portfolioAccount = Account('Portfolio', self.currency, transactions)
+            row = SimpleNamespace(date=day, **{name: int(column[i]) / scale for name, column in columns.items()})
+            row.total = int(total[i]) / scale
+            rows.append(row)
 
-        if self.filter:
-            portfolioAccount.transactions = [t for t in portfolioAccount.transactions if t.matchesFilter(self.filter)]
+        return rows
 
-        if self.dateLowerBound:
-            portfolioAccount.transactions = [t for t in portfolioAccount.transactions if t.date >= self.dateLowerBound]
+    def withLimit(self, limit: int):
+
+        assert limit is None or limit >= 0, f'limit must be positive, got {limit}'
+
+        self.limit = limit
+        return self
+
+    def plan(self) -> QueryPlan:
+
+        dateLowerBound = max(filter(None, [self.dateLowerBound, self.filter.dateLowerBound]), default=None)
+        dateUpperBound = min(filter(None, [self.dateUpperBound, self.filter.dateUpperBound]), default=None)
+
+        return QueryPlan(list(self.accounts), self.currency, self.filter, dateLowerBound, dateUpperBound, self.limit)
+
+    def build(self) -> Account:
 
-        if self.dateUpperBound:
-            portfolioAccount.transactions = [t for t in portfolioAccount.transactions if t.date <= self.dateUpperBound]
+        # rows come out of the plan filtered, converted and merged newest first
+        plan = self.plan()
+        table = plan.execute()
 
-        return portfolioAccount
\ No newline at end of file
+        self.matched = plan.matched
+        return Account('Portfolio', self.currency, table, presorted=True)
@@ -0,0 +1,74 @@
+import heapq
+import numpy
+import itertools
+import datetime
+
+from finance.Transaction import TransactionFilter
+from finance.TransactionTable import TransactionTable
+
+class QueryPlan:
+
+    # Everything a portfolio query needs, resolved once before any row is touched:
+    # the accounts it can match, the date range, the row predicates and the target currency
+    def __init__(self, accounts: list, currency: str, filter: TransactionFilter, dateLowerBound: datetime.date = None, dateUpperBound: datetime.date = None, limit: int = None):
+
+        self.currency: str = currency
+        self.filter: TransactionFilter = filter
+
+        self.dateLowerBound: datetime.date = dateLowerBound
+        self.dateUpperBound: datetime.date = dateUpperBound
+
+        # only the newest rows are produced, the newest N overall are within the newest N of each account
+        self.limit: int = limit
+        self.matched: int = 0 # rows matching the query, before the limit
+
+        # an account filter that cannot match an account's name skips the whole account
+        self.accounts: list = [
+            account for account in accounts
+            if filter.account is None or filter.account.lower() in account.name.lower()
+        ]
+
+    def runs(self) -> list[TransactionTable]:
+
+        self.matched = 0
+        runs: list[TransactionTable] = []
+        for account in self.accounts:
+
+            # accounts are sorted by date: slice the date range first, before any other predicate runs
+            table = account.dateRange(self.dateLowerBound, self.dateUpperBound)
+
+            # then filter on the account's own table, where its description index lives
+            table = table.take(self.filter.mask(table))
+
+            if not account.newestFirst:
+                table = table.take(slice(None, None, -1))
+
+            self.matched += len(table)
+            if self.limit is not None:
+                table = table.take(slice(0, self.limit))
+
+            # only the rows that survived get converted
+            table.convertToCurrency(self.currency)
+            runs.append(table)
+
+        return runs
+
+    def execute(self) -> TransactionTable:
+
+        runs = [run for run in self.runs() if len(run)]
+        if len(runs) == 1:
+            return runs[0]
+
+        # every run is newest first already: merge them on (date, uniqueId),
+        # ties keep the account order like the stable sort they replace
+        offsets = numpy.cumsum([0] + [len(run) for run in runs])
+        merged = heapq.merge(*[
+            zip(run.date.astype(numpy.int64).tolist(), run.uniqueId.tolist(), range(offset, offset + len(run)))
+            for run, offset in zip(runs, offsets.tolist())
+        ], key=lambda row: row[:2], reverse=True)
+
+        if self.limit is not None:
+            merged = itertools.islice(merged, self.limit)
+
+        order = numpy.fromiter((row[2] for row in merged), dtype=numpy.int64)
+        return TransactionTable.concat(runs).take(order)
@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+
+class ResultCache:
+
+    # Results of previous queries on disk as json (strings and tuples of them), keyed by the normalized query and
+    # the state of every file it reads, least recently used entries are evicted once the directory grows past maxBytes
+    def __init__(self, directory: str, query: dict, inputFiles: list[str], maxBytes: int = 32 * 1024 * 1024):
+
+        self.directory: str = directory
+        self.maxBytes: int = maxBytes
+
+        digest = hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode())
+        for path in sorted(inputFiles):
+
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                digest.update(f'{path} {stat.st_mtime_ns} {stat.st_size}'.encode())
+
+        self.key: str = digest.hexdigest()
+
+    def _path(self) -> str:
+        return os.path.join(self.directory, f'{self.key}.json')
+
+    def get(self) -> object:
+
+        if self.key is None or not os.path.exists(self._path()):
+            return None
+
+        try:
+            with open(self._path(), 'r') as f:
+                value = json.load(f)
+        except Exception: # unreadable entry, ex: written by an older version
+            os.remove(self._path())
+            return None
+
+        os.utime(self._path()) # most recently used
+        return tuple(value) if isinstance(value, list) else value # json has no tuples
+
+    def put(self, value: tuple | str):
+
+        if self.key is None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        temporaryPath = self._path() + '.tmp'
+        with open(temporaryPath, 'w') as f:
+            json.dump(value, f)
+
+        os.replace(temporaryPath, self._path())
+        self._evict()
+
+    def _evict(self):
+
+        # every finished entry, including ones left in an older format
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if not name.endswith('.tmp')]
+        entries.sort(key=os.path.getmtime, reverse=True)
+
+        totalBytes = 0
+        for path in entries:
+
+            totalBytes += os.path.getsize(path)
+            if totalBytes > self.maxBytes:
+                os.remove(path)
+
+    def clear(self):
+
+        # refreshed data: nothing cached so far can be reused, nor should this run be cached
+        self.key = None
+        if not os.path.isdir(self.directory):
+            return
+
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
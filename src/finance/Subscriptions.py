@@ -0,0 +1,84 @@
+import numpy
+import datetime
+from statistics import median
+from types import SimpleNamespace
+
+from utils.normalize import normalize
+from finance.Transaction import Currency
+from finance.TransactionTable import TransactionTable
+
+def merchantKey(description: str) -> str:
+    # words without digits: "Spotify P1234" and "Spotify P5678" are the same merchant
+    return ' '.join(word for word in normalize(str(description)).words.split() if not any(c.isdigit() for c in word))
+
+def merchantCodes(descriptions: list[str]) -> numpy.ndarray:
+
+    # merchant code of each distinct description (a table's descriptions), computed per description rather than per row
+    merchants: dict[str, int] = {}
+    return numpy.array([merchants.setdefault(merchantKey(d), len(merchants)) for d in descriptions], dtype=numpy.int64)
+
+class Subscriptions:
+
+    MinCharges: int = 3
+    MinPeriod: int = 5 # days
+    MaxPeriod: int = 400 # yearly, with some slack
+
+    # log scale amount buckets, a price change of a few percent stays in the same bucket
+    AmountBucketRatio: float = 1.1
+
+    # Recurring charges: debits grouped by merchant and amount bucket, periodic when their intervals barely vary
+    def __init__(self, table: TransactionTable, currency: str):
+
+        self.currency: str = currency
+        self.subscriptions: list[SimpleNamespace] = []
+
+        debits = numpy.flatnonzero(table.credit < 0)
+        if len(debits) == 0:
+            return
+
+        merchantOfDescription = merchantCodes(table.descriptions)
+
+        amounts = -table.credit[debits]
+        buckets = numpy.rint(numpy.log(amounts.astype(numpy.float64)) / numpy.log(Subscriptions.AmountBucketRatio)).astype(numpy.int64)
+        buckets -= buckets.min()
+
+        keys = merchantOfDescription[table.descriptionCode[debits]] * (buckets.max() + 1) + buckets
+
+        # rows of each group next to each other, oldest first
+        days = table.date[debits].astype(numpy.int64)
+        order = numpy.lexsort((days, keys))
+        keys, days, rows = keys[order], days[order], debits[order]
+
+        starts = numpy.flatnonzero(numpy.diff(keys, prepend=-1))
+        ends = numpy.append(starts[1:], len(keys))
+
+        asOf = int(days.max()) # relative to the newest charge, cached history can be old
+        for start, end in zip(starts.tolist(), ends.tolist()):
+
+            if end - start < Subscriptions.MinCharges:
+                continue
+
+            intervals = numpy.diff(days[start:end]).tolist()
+            period = median(intervals)
+            deviation = median(abs(i - period) for i in intervals)
+
+            # periodic: intervals within a few days (or 5%) of their median
+            if not Subscriptions.MinPeriod <= period <= Subscriptions.MaxPeriod or deviation > max(2, 0.05 * period):
+                continue
+
+            # still active: the next charge is not overdue by more than one period
+            last = int(days[end - 1])
+            if last + 2 * period < asOf:
+                continue
+
+            latest = table.row(int(rows[end - 1]))
+            self.subscriptions.append(SimpleNamespace(
+                description=latest.description,
+                period=int(round(period)),
+                amount=int(median(amounts[order[start:end]].tolist())) / Currency.scale(currency),
+                charges=end - start,
+                last=latest.date,
+                next=latest.date + datetime.timedelta(days=int(round(period))),
+            ))
+
+        self.subscriptions.sort(key=lambda row: row.next)
@@ -0,0 +1,94 @@
+import numpy
+from types import SimpleNamespace
+from typing import Callable
+
+from finance.Transaction import TransactionType, Currency
+from finance.TransactionTable import TransactionTable
+
+def _monthKey(table: TransactionTable, accountCurrencies: dict[str, str]) -> tuple[numpy.ndarray, list[str]]:
+
+    months, codes = numpy.unique(table.date.astype('datetime64[M]'), return_inverse=True)
+    return codes, [str(m) for m in months]
+
+def _typeKey(table: TransactionTable, accountCurrencies: dict[str, str]) -> tuple[numpy.ndarray, list[str]]:
+
+    labels = [''] * (max(t.value for t in TransactionType) + 1)
+    for t in TransactionType:
+        labels[t.value] = t.name
+
+    return table.typeCode.astype(numpy.int64), labels
+
+def _accountKey(table: TransactionTable, accountCurrencies: dict[str, str]) -> tuple[numpy.ndarray, list[str]]:
+    return table.accountCode.astype(numpy.int64), [str(a) for a in table.accounts]
+
+def _currencyKey(table: TransactionTable, accountCurrencies: dict[str, str]) -> tuple[numpy.ndarray, list[str]]:
+
+    # amounts are all converted by now, so the currency a row was in is the one of its account
+    # (merging converts every row to its account's currency)
+    currencyOfAccount = [accountCurrencies.get(str(a), ', '.join(table.currencies)) for a in table.accounts]
+    currencies = sorted(set(currencyOfAccount))
+
+    codes = numpy.array([currencies.index(c) for c in currencyOfAccount], dtype=numpy.int64)
+    return codes[table.accountCode], currencies
+
+class Summary:
+
+    # group key -> (integer code per row, label per code)
+    Keys: dict[str, Callable[[TransactionTable, dict[str, str]], tuple[numpy.ndarray, list[str]]]] = {
+        'month': _monthKey,
+        'type': _typeKey,
+        'account': _accountKey,
+        'currency': _currencyKey,
+    }
+
+    # Totals, counts, means and fees per group, table amounts must all be in the given currency,
+    # accountCurrencies (account name -> currency) tells which currency each row was in before that
+    def __init__(self, table: TransactionTable, currency: str, groupBy: list[str], accountCurrencies: dict[str, str] = None):
+
+        for key in groupBy:
+            assert key in Summary.Keys, f'Cannot summarize by {key}, expected any of: {", ".join(Summary.Keys.keys())}'
+
+        self.groupBy: list[str] = groupBy
+        self.currency: str = currency
+
+        keys = [Summary.Keys[key](table, accountCurrencies or {}) for key in groupBy]
+
+        # one integer per combination of codes, compacted to the groups that actually occur
+        combined = numpy.zeros(len(table), dtype=numpy.int64)
+        for codes, labels in keys:
+            combined = combined * max(len(labels), 1) + codes
+
+        groups, inverse = numpy.unique(combined, return_inverse=True)
+
+        self.count: numpy.ndarray = numpy.bincount(inverse, minlength=len(groups))
+        self.total: numpy.ndarray = numpy.rint(numpy.bincount(inverse, weights=table.credit, minlength=len(groups))).astype(numpy.int64)
+        self.fees: numpy.ndarray = numpy.rint(numpy.bincount(inverse, weights=table.feeAmount, minlength=len(groups))).astype(numpy.int64)
+
+        # group -> label of each key, decoded back from the combined integer
+        self.labels: list[list[str]] = []
+        remainder = groups
+        for codes, labels in reversed(keys):
+            self.labels.insert(0, [labels[c] for c in (remainder % max(len(labels), 1)).tolist()])
+            remainder = remainder // max(len(labels), 1)
+
+        # newest months first, like the transactions listing
+        sortKeys = [numpy.array(labels) for labels in self.labels]
+        sortKeys = [numpy.unique(k, return_inverse=True)[1] * (-1 if key == 'month' else 1) for k, key in zip(sortKeys, groupBy)]
+        self.order: numpy.ndarray = numpy.lexsort(sortKeys[::-1]) if sortKeys else numpy.arange(len(groups))
+
+    def rows(self) -> list[SimpleNamespace]:
+
+        scale = Currency.scale(self.currency)
+
+        rows: list[SimpleNamespace] = []
+        for g in self.order.tolist():
+
+            row = SimpleNamespace(**{key: self.labels[k][g] for k, key in enumerate(self.groupBy)})
+            row.count = int(self.count[g])
+            row.total = int(self.total[g]) / scale
+            row.mean = round(int(self.total[g]) / scale / max(int(self.count[g]), 1), 2)
+            row.fees = int(self.fees[g]) / scale
+
+            rows.append(row)
+
+        return rows
@@ -2,14 +2,108 @@
 import sys
 
 import datetime
+import numpy
 import pandas
 from enum import Enum, auto
 
 from finance.helpers import parseDate, parseFloat
-
-import unicodedata
+from utils.normalize import normalize
 
 import re
+import weakref
+from typing import Callable
+
+class CurrencyTable:
+
+    # Dense matrix of every cross rate, matrix[i, j] converts currency i into currency j
+    # history holds dated rates per pair ("EUR USD" -> sorted dates, rates) for as-of conversions
+    def __init__(self, rates: dict[str, float], history: dict[str, tuple[numpy.ndarray, numpy.ndarray]] = None):
+
+        history = history or {}
+
+        # the latest known rate of a pair stands in for its static rate
+        rates = {**rates, **{pair: float(pairRates[-1]) for pair, (_, pairRates) in history.items()}}
+        pairs = [(*key.split(), rate) for key, rate in rates.items()]
+
+        self.currencies: list[str] = sorted({c for fromCurrency, toCurrency, _ in pairs for c in (fromCurrency, toCurrency)})
+        self.index: dict[str, int] = {c: i for i, c in enumerate(self.currencies)}
+
+        self.history: dict[tuple[int, int], tuple[numpy.ndarray, numpy.ndarray]] = {}
+        for pair, pairHistory in history.items():
+            fromCurrency, toCurrency = pair.split()
+            self.history[(self.index[fromCurrency], self.index[toCurrency])] = pairHistory
+
+        neighbors: dict[int, list[tuple[int, float]]] = {i: [] for i in range(len(self.currencies))}
+        for fromCurrency, toCurrency, rate in pairs:
+            neighbors[self.index[fromCurrency]].append((self.index[toCurrency], rate))
+            neighbors[self.index[toCurrency]].append((self.index[fromCurrency], 1. / rate))
+
+        # derive cross rates through the fewest intermediate currencies (breadth first from each currency)
+        self.matrix = numpy.full((len(self.currencies), len(self.currencies)), numpy.nan)
+        self.previous = numpy.full((len(self.currencies), len(self.currencies)), -1) # last hop of each path
+
+        for source in range(len(self.currencies)):
+
+            self.matrix[source, source] = 1.
+            queue: list[int] = [source]
+
+            for node in queue:
+                for neighbor, rate in neighbors[node]:
+
+                    if not numpy.isnan(self.matrix[source, neighbor]):
+                        continue
+
+                    self.matrix[source, neighbor] = self.matrix[source, node] * rate
+                    self.previous[source, neighbor] = node
+                    queue.append(neighbor)
+
+    def supports(self, currency: str) -> bool:
+        return currency in self.index
+
+    def getRate(self, fromCurrency: str, toCurrency: str) -> float:
+
+        if fromCurrency == toCurrency:
+            return 1.
+
+        rate = numpy.nan
+        if self.supports(fromCurrency) and self.supports(toCurrency):
+            rate = self.matrix[self.index[fromCurrency], self.index[toCurrency]]
+
+        assert not numpy.isnan(rate), f'Currency conversion rate from {fromCurrency} to {toCurrency} not found'
+        return float(rate)
+
+    def _hopRates(self, fromIndex: int, toIndex: int, dates: numpy.ndarray) -> numpy.ndarray:
+
+        # the pair's own history first, the reverse one inverted, the static rate otherwise
+        if (fromIndex, toIndex) in self.history:
+            historyDates, historyRates = self.history[(fromIndex, toIndex)]
+        elif (toIndex, fromIndex) in self.history:
+            historyDates, historyRates = self.history[(toIndex, fromIndex)]
+            historyRates = 1. / historyRates
+        else:
+            return numpy.full(len(dates), self.matrix[fromIndex, toIndex])
+
+        # as-of join: the last rate published on or before each date (the first known rate before that)
+        positions = numpy.searchsorted(historyDates, dates, side='right') - 1
+
+        return historyRates[numpy.clip(positions, 0, None)]
+
+    def ratesOn(self, fromCurrency: str, toCurrency: str, dates: numpy.ndarray) -> numpy.ndarray:
+
+        rate = self.getRate(fromCurrency, toCurrency)
+        if fromCurrency == toCurrency or not self.history:
+            return numpy.full(len(dates), rate)
+
+        source, node = self.index[fromCurrency], self.index[toCurrency]
+        rates = numpy.ones(len(dates))
+
+        # walk the conversion path back from the target, each hop converted as of each date
+        while node != source:
+            previous = self.previous[source, node]
+            rates *= self._hopRates(previous, node, dates)
+            node = previous
+
+        return rates
 
 class Currency:
 
@@ -17,30 +111,70 @@ class Currency:
         'EUR USD': 1.17,
     }
 
+    # minor units per major unit, amounts are stored as integers of the minor unit
+    _Scale = {
+        'USD': 100,
+        'EUR': 100,
+    }
+
+    _History: dict[str, tuple[numpy.ndarray, numpy.ndarray]] = {}
+    _Table: CurrencyTable = None
+
     @staticmethod
-    def currencySupported(currency: str) -> bool:
+    def scale(currency: str) -> int:
+        return Currency._Scale.get(currency, 100)
 
-        for key in Currency._Rate.keys():
-            if currency in key.split():
-                return True
+    @staticmethod
+    def table() -> CurrencyTable:
+
+        if Currency._Table is None:
+            Currency._Table = CurrencyTable(Currency._Rate, Currency._History)
+
+        return Currency._Table
 
-        return False
-        
     @staticmethod
-    def getRate(fromCurrency: str, toCurrency: str) -> float:
+    def loadRateHistory(csvFilePath: str):
 
-        if fromCurrency == toCurrency:
-            return 1.
-        
-        key = f'{fromCurrency} {toCurrency}'
-        if key in Currency._Rate:
-            return Currency._Rate[key]
+        # columns: date (yyyy-mm-dd), pair (as in _Rate, ex: "EUR USD"), rate
+        dataFrame = pandas.read_csv(csvFilePath)
+
+        # both directions of a pair ("EUR USD" and "USD EUR") end up in one history, in the direction
+        # of _Rate (or alphabetical), the reversed rows inverted
+        parts: dict[str, list[tuple[numpy.ndarray, numpy.ndarray]]] = {}
+        for pair, rows in dataFrame.groupby('pair'):
+
+            dates = pandas.to_datetime(rows['date'], format='%Y-%m-%d').to_numpy(dtype='datetime64[D]')
+            rates = rows['rate'].to_numpy(dtype=numpy.float64)
+
+            fromCurrency, toCurrency = pair.split()
+            if f'{toCurrency} {fromCurrency}' in Currency._Rate or (f'{fromCurrency} {toCurrency}' not in Currency._Rate and toCurrency < fromCurrency):
+                fromCurrency, toCurrency, rates = toCurrency, fromCurrency, 1. / rates
+
+            parts.setdefault(f'{fromCurrency} {toCurrency}', []).append((dates, rates))
 
-        key = f'{toCurrency} {fromCurrency}'
-        if key in Currency._Rate:
-            return 1. / Currency._Rate[key]
-        
-        assert False, f'Currency conversion rate from {fromCurrency} to {toCurrency} not found'
+        history: dict[str, tuple[numpy.ndarray, numpy.ndarray]] = {}
+        for pair, pairParts in parts.items():
+
+            dates = numpy.concatenate([dates for dates, _ in pairParts])
+            rates = numpy.concatenate([rates for _, rates in pairParts])
+
+            order = numpy.argsort(dates, kind='stable')
+            history[pair] = (dates[order], rates[order])
+
+        Currency._History = history
+        Currency._Table = None
+
+    @staticmethod
+    def currencySupported(currency: str) -> bool:
+        return Currency.table().supports(currency)
+
+    @staticmethod
+    def getRate(fromCurrency: str, toCurrency: str, date: datetime.date = None) -> float:
+
+        if date is None:
+            return Currency.table().getRate(fromCurrency, toCurrency)
+
+        return float(Currency.table().ratesOn(fromCurrency, toCurrency, numpy.array([date], dtype='datetime64[D]'))[0])
 
 class TransactionType(Enum):
     other = auto()
@@ -309,44 +443,12 @@ class Transaction:
         if isinstance(self.date, str):
             self.date = parseDate(self.date, dateFormat='%Y-%m-%d')
 
-    def toDataFrameRow(self) -> dict:
-
-        self.convertStringAttributes()
-        data: dict = {}
-        for attrName, attr in self.__dict__.items():
-            data[attrName] = str(attr)
-
-        return data
-
-    @staticmethod
-    def fromDataFrameRow(row: pandas.Series) -> 'Transaction':
-
-        t = Transaction()
-        # iterate over the __dict__ of the transaction and set the attributes from the row
-        for attrName in t.__dict__.keys():
-
-            assert attrName in row, f'Attribute {attrName} not found in data frame row'
-
-            value = row[attrName]
-            t.__setattr__(attrName, value)
-            t.__dict__[attrName] = str(value)
-
-        try:
-            t.date = parseDate(t.date, dateFormat='%Y-%m-%d')
-        except ValueError:
-            t.date = parseDate(t.date, dateFormat='%m/%d/%Y')
-
-        t.convertStringAttributes()
-        t.guessAndFillType()
-
-        return t
-
     def convertToCurrency(self, targetCurrency: str):
 
         if self.currency == targetCurrency:
             return
 
-        rate = Currency.getRate(self.currency, targetCurrency)
+        rate = Currency.getRate(self.currency, targetCurrency, self.date)
 
         self.credit *= rate
         self.feeAmount *= rate
@@ -360,88 +462,182 @@ class Transaction:
             self.description = "No Description"
             return
 
-        regexToRemove = ['branch', 'pos', 'prch', 'cash', 'onsite', 'offsite', 'mpfx', r'm\S*8831\S*', r'[^\w]{2,}', '^-', r'\b\d+\b']
-        for w in regexToRemove:
-            self.description = re.sub(w, ' ', self.description, flags=re.IGNORECASE)
+        self.description = normalize(self.description).clean or "No Description"
+
+    def guessAndFillType(self) -> TransactionType:
+
+        self.cleanDescription()
 
-        self.description = re.sub(r'\s+', ' ', self.description).strip()
+        self.type = Categorizer.guessType(self.description)
+        return self.type
 
-        def removeAccents(inputStr: str) -> str:
-            return ''.join(
-                c for c in unicodedata.normalize('NFD', inputStr) if unicodedata.category(c) != 'Mn'
-            )
+    def matchesFilter(self, filter: 'TransactionFilter') -> bool:
 
-        self.description = removeAccents(self.description)
+        assert isinstance(filter, TransactionFilter), f'filter must be of type TransactionFilter, got {type(filter)}'
+        return filter.compiled()(self)
 
-        # capitalize first letter of each word, lowercase the rest
-        self.description = ' '.join(word.capitalize() for word in self.description.split())
+class Categorizer:
 
-    def guessAndFillType(self) -> TransactionType:
+    # Every keyword of Transaction.CategoryMap compiled once into a single Aho-Corasick automaton,
+    # so a description is scored against all categories in one pass over its characters
+    _goto: list[dict[str, int]] = None
+    _fail: list[int] = None
+    _output: list[list[int]] = None # keyword indices ending at each state
 
-        bestScore = 0
-        bestGuess = TransactionType.food
+    _keywordLength: list[int] = None
+    _keywordCategory: list[int] = None
+    _categories: list[TransactionType] = None
 
-        for category, keywords in Transaction.CategoryMap.items():
+    # Merchant memo, keyed by normalized lowercase description: keyword results are remembered
+    # so categories stay stable when CategoryMap changes, manual overrides beat everything
+    _Memo: dict[str, TransactionType] = {}
+    _Overrides: dict[str, TransactionType] = {}
+    _MemoChanged: bool = False
 
-            self.cleanDescription()
+    @staticmethod
+    def _build():
 
-            score = sum(self.description.lower().count(w) for w in keywords)
-            if score <= bestScore:
-                continue
+        Categorizer._categories = list(Transaction.CategoryMap.keys())
+        Categorizer._keywordLength = []
+        Categorizer._keywordCategory = []
 
-            bestScore = score
-            bestGuess = category
+        goto: list[dict[str, int]] = [{}]
+        output: list[list[int]] = [[]]
 
-        self.type = bestGuess
-        return bestGuess
+        for categoryIndex, keywords in enumerate(Transaction.CategoryMap.values()):
+            for keyword in keywords:
 
-    def matchesFilter(self, filter: 'TransactionFilter') -> bool:
+                state = 0
+                for c in keyword:
+                    if c not in goto[state]:
+                        goto.append({})
+                        output.append([])
+                        goto[state][c] = len(goto) - 1
+                    state = goto[state][c]
 
-        assert isinstance(filter, TransactionFilter), f'filter must be of type TransactionFilter, got {type(filter)}'
+                output[state].append(len(Categorizer._keywordLength))
+                Categorizer._keywordLength.append(len(keyword))
+                Categorizer._keywordCategory.append(categoryIndex)
 
-        if filter is None or filter.isEmpty():
-            return True
+        # breadth first, so the fail state of a parent is always known before its children
+        fail: list[int] = [0] * len(goto)
+        queue: list[int] = list(goto[0].values())
 
-        attributesToCompare = ['account', 'description', 'type', 'date']
-        match: bool = True
+        for state in queue:
+            for c, child in goto[state].items():
 
-        for attr in attributesToCompare:
+                fallback = fail[state]
+                while fallback and c not in goto[fallback]:
+                    fallback = fail[fallback]
 
-            filterValue = filter.__dict__[attr]
-            if filterValue == None:
+                fail[child] = goto[fallback].get(c, 0)
+                output[child] = output[child] + output[fail[child]]
+                queue.append(child)
+
+        Categorizer._goto = goto
+        Categorizer._fail = fail
+        Categorizer._output = output
+
+    @staticmethod
+    def loadMemo(csvFilePath: str):
+
+        # columns: description, type, override (True for manual entries)
+        dataFrame = pandas.read_csv(csvFilePath, keep_default_na=False)
+
+        for description, typeName, override in zip(dataFrame['description'], dataFrame['type'], dataFrame['override']):
+
+            if typeName not in TransactionType.__members__:
+                print(f'[WARN] Transaction type: {typeName} not found in TransactionType enum. Ignoring memo entry for "{description}".', file=sys.stderr)
                 continue
 
-            transactionValue = self.__dict__[attr]
-            if transactionValue == None:
-                return False
+            memo = Categorizer._Overrides if str(override).lower() == 'true' else Categorizer._Memo
+            memo[normalize(str(description)).lower] = TransactionType[typeName]
 
-            if not isinstance(transactionValue, str):
-                match &= (transactionValue == filterValue)
+        Categorizer._MemoChanged = False
 
-            if isinstance(transactionValue, str):
-                match &= (filterValue.lower() in transactionValue.lower())
+    @staticmethod
+    def saveMemo(csvFilePath: str):
 
-            if not match:
-                return False
+        if not Categorizer._MemoChanged:
+            return
+
+        rows = [(description, t.name, True) for description, t in sorted(Categorizer._Overrides.items())]
+        rows += [(description, t.name, False) for description, t in sorted(Categorizer._Memo.items())]
+
+        pandas.DataFrame(rows, columns=['description', 'type', 'override']).to_csv(csvFilePath, index=False)
+        Categorizer._MemoChanged = False
+
+    @staticmethod
+    def applyOverrides(table):
+
+        # cached tables keep the types they were saved with, only manual overrides are reapplied,
+        # looked up once per distinct description
+        if not Categorizer._Overrides or len(table) == 0:
+            return
+
+        overrides = [Categorizer._Overrides.get(normalize(d).lower) for d in table.descriptions]
+        codes = numpy.array([t.value if t else 0 for t in overrides], dtype=numpy.int8)[table.descriptionCode]
+
+        table.typeCode = numpy.where(codes > 0, codes, table.typeCode).astype(numpy.int8)
+
+    @staticmethod
+    def guessType(description: str) -> TransactionType:
+
+        key = normalize(description).lower
+
+        if key in Categorizer._Overrides:
+            return Categorizer._Overrides[key]
+
+        if key in Categorizer._Memo:
+            return Categorizer._Memo[key]
+
+        Categorizer._Memo[key] = Categorizer._guessFromKeywords(key)
+        Categorizer._MemoChanged = True
+
+        return Categorizer._Memo[key]
+
+    @staticmethod
+    def _guessFromKeywords(description: str) -> TransactionType:
+
+        if Categorizer._goto is None:
+            Categorizer._build()
+
+        goto, fail, output = Categorizer._goto, Categorizer._fail, Categorizer._output
+        keywordLength, keywordCategory = Categorizer._keywordLength, Categorizer._keywordCategory
 
-        # Dates
-        if filter.dateLowerBound and self.date < filter.dateLowerBound:
-            return False
+        scores: list[int] = [0] * len(Categorizer._categories)
+        lastEnd: dict[int, int] = {} # same semantics as str.count: occurrences of one keyword never overlap
 
-        if filter.dateUpperBound and self.date > filter.dateUpperBound:
-            return False
+        state = 0
+        for end, c in enumerate(description, start=1):
 
-        # Exclude term
-        fullString: str = ' - '.join([
-                                    self.account,
-                                    self.description,
-                                    self.type.name
-                                      ]).lower()
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
 
-        if filter.excludeRegex is not None and re.search(filter.excludeRegex, fullString):
-            return False
+            for k in output[state]:
 
-        return True
+                if end - keywordLength[k] < lastEnd.get(k, 0):
+                    continue
+
+                lastEnd[k] = end
+                scores[keywordCategory[k]] += 1
+
+        # first category with the strictly highest score wins, food when nothing matched
+        bestScore = max(scores)
+        if bestScore == 0:
+            return TransactionType.food
+
+        return Categorizer._categories[scores.index(bestScore)]
+
+    @staticmethod
+    def categorize(transactions: list[Transaction]):
+
+        # repeat merchants are a memo lookup, only new descriptions get scored
+        for t in transactions:
+
+            t.cleanDescription()
+            t.type = Categorizer.guessType(t.description)
 
 class TransactionFilter(Transaction):
 
@@ -463,3 +659,118 @@ class TransactionFilter(Transaction):
 
     def isEmpty(self) -> bool:
         return all(value is None for value in self.__dict__.values())
+
+    AttributesToCompare = ['account', 'description', 'type', 'date']
+
+    # compiled predicate of each filter with the attributes it was compiled from, kept off the instance
+    # since every attribute of a filter is a criterion (see isEmpty)
+    _Compiled: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def compiled(self) -> Callable[[Transaction], bool]:
+
+        # compile() once, again only after the filter changed
+        state = tuple(self.__dict__.items())
+        cached = TransactionFilter._Compiled.get(self)
+
+        if cached is None or cached[0] != state:
+            cached = (state, self.compile())
+            TransactionFilter._Compiled[self] = cached
+
+        return cached[1]
+
+    def compile(self) -> Callable[[Transaction], bool]:
+
+        if self.isEmpty():
+            return lambda t: True
+
+        # (attribute, value, pre-lowered needle) for every attribute the filter sets
+        checks: list[tuple[str, object, str]] = []
+        for attr in TransactionFilter.AttributesToCompare:
+
+            value = self.__dict__[attr]
+            if value is not None:
+                checks.append((attr, value, value.lower() if isinstance(value, str) else None))
+
+        dateLowerBound = self.dateLowerBound
+        dateUpperBound = self.dateUpperBound
+        exclude: re.Pattern = re.compile(self.excludeRegex) if self.excludeRegex is not None else None
+
+        def matches(t: Transaction) -> bool:
+
+            for attr, value, needle in checks:
+
+                transactionValue = t.__dict__[attr]
+                if transactionValue is None:
+                    return False
+
+                if isinstance(transactionValue, str):
+                    if needle not in transactionValue.lower():
+                        return False
+
+                elif transactionValue != value:
+                    return False
+
+            if dateLowerBound and t.date < dateLowerBound:
+                return False
+
+            if dateUpperBound and t.date > dateUpperBound:
+                return False
+
+            if exclude is not None and exclude.search(' - '.join([t.account, t.description, t.type.name]).lower()):
+                return False
+
+            return True
+
+        return matches
+
+    def mask(self, table) -> numpy.ndarray:
+
+        # same result as compile(), for a TransactionTable: string tests run once per distinct
+        # dictionary value, then get gathered onto the rows through their codes
+        keep = numpy.ones(len(table), dtype=bool)
+        if self.isEmpty():
+            return keep
+
+        if self.account is not None:
+            needle = self.account.lower()
+            keep &= numpy.array([v is not None and needle in v.lower() for v in table.accounts], dtype=bool)[table.accountCode]
+
+        if self.description is not None:
+            # trigram index candidates, verified, instead of testing every distinct description
+            matching = numpy.zeros(len(table.descriptions), dtype=bool)
+            matching[table.descriptionIndex().search(self.description)] = True
+            keep &= matching[table.descriptionCode]
+
+        if self.type is not None:
+            keep &= table.typeCode == self.type.value
+
+        if self.date is not None:
+            keep &= table.date == numpy.datetime64(self.date)
+
+        if self.dateLowerBound:
+            keep &= table.date >= numpy.datetime64(self.dateLowerBound)
+
+        if self.dateUpperBound:
+            keep &= table.date <= numpy.datetime64(self.dateUpperBound)
+
+        if self.excludeRegex is not None and keep.any():
+
+            exclude: re.Pattern = re.compile(self.excludeRegex)
+
+            # one search per distinct (account, description, type, paired) combination,
+            # rows paired as transfers between accounts also match "transfer" whatever their type
+            keys = ((table.accountCode.astype(numpy.int64) * len(table.descriptions) + table.descriptionCode) * 256 + table.typeCode) * 2 + (table.transferId != 0)
+            uniqueKeys, inverse = numpy.unique(keys, return_inverse=True)
+
+            excluded = numpy.array([
+                exclude.search(' - '.join([
+                    table.accounts[key // 2 // 256 // len(table.descriptions)],
+                    table.descriptions[key // 2 // 256 % len(table.descriptions)],
+                    TransactionType(key // 2 % 256).name,
+                ] + (['transfer'] if key % 2 else [])).lower()) is not None
+                for key in uniqueKeys.tolist()
+            ], dtype=bool)
+
+            keep &= ~excluded[inverse]
+
+        return keep
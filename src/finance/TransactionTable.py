@@ -0,0 +1,474 @@
+
+import os, sys
+import hashlib
+
+import numpy
+import pandas
+import datetime
+from typing import Callable
+
+from finance.Transaction import Transaction, TransactionType, Currency
+from finance.TrigramIndex import TrigramIndex
+
+def _parseStrings(column: pandas.Series) -> numpy.ndarray:
+    # empty cells read back as "nan", like str() of the value read by pandas
+    return column.astype(object).where(column.notna(), 'nan').astype(str).to_numpy(dtype=object)
+
+def _parseIntegers(column: pandas.Series) -> numpy.ndarray:
+    return column.to_numpy(dtype=numpy.int64)
+
+def _parseAmounts(column: pandas.Series) -> numpy.ndarray:
+
+    if not pandas.api.types.is_numeric_dtype(column): # thousands separators, as accepted by parseFloat
+        column = column.astype(str).str.replace(',', '')
+
+    return pandas.to_numeric(column).to_numpy(dtype=numpy.float64)
+
+def _parseDates(column: pandas.Series) -> numpy.ndarray:
+
+    dates = pandas.to_datetime(column, format='%Y-%m-%d', errors='coerce')
+
+    # older caches wrote dates as mm/dd/yyyy
+    legacy = dates.isna().to_numpy()
+    if legacy.any():
+        dates[legacy] = pandas.to_datetime(column[legacy], format='%m/%d/%Y')
+
+    return dates.to_numpy(dtype='datetime64[D]')
+
+def _parseTypes(column: pandas.Series) -> numpy.ndarray:
+
+    names = column.astype(str)
+    unknown = ~names.isin(TransactionType.__members__.keys())
+
+    for name in names[unknown].unique():
+        print(f'[WARN] Transaction type: {name} not found in TransactionType enum. Defaulting to "other".', file=sys.stderr)
+
+    codes = names.map({t.name: t.value for t in TransactionType})
+    codes[unknown] = TransactionType.other.value
+
+    return codes.to_numpy(dtype=numpy.int8)
+
+class TransactionTable:
+
+    # Cached transactions, one column per field: field -> (column dtype, parser of the raw pandas column)
+    Schema: dict[str, tuple[object, Callable[[pandas.Series], numpy.ndarray]]] = {
+        'account':          (str, _parseStrings),
+        'uniqueId':         (numpy.int64, _parseIntegers),
+        'description':      (str, _parseStrings),
+        'date':             ('datetime64[D]', _parseDates),
+        'type':             (numpy.int8, _parseTypes),
+        'credit':           (numpy.int64, _parseAmounts),
+        'feePercentage':    (numpy.float64, _parseAmounts),
+        'feeAmount':        (numpy.int64, _parseAmounts),
+        'balance':          (numpy.int64, _parseAmounts),
+        'currency':         (str, _parseStrings),
+    }
+
+    # table columns with a different name than their field, dictionary encoded ones get (codes, values)
+    SchemaColumns: dict[str, str | tuple[str, str]] = {
+        'type': 'typeCode',
+        'account': ('accountCode', 'accounts'),
+        'description': ('descriptionCode', 'descriptions'),
+        'currency': ('currencyCode', 'currencies'),
+    }
+
+    # numeric columns, one numpy array each
+    ArrayColumns = ['uniqueId', 'date', 'credit', 'feePercentage', 'feeAmount', 'balance', 'balanceReported', 'typeCode', 'transferId', 'accountCode', 'descriptionCode', 'currencyCode']
+
+    # amounts are exact integers in minor units of the row's currency (cents), see Currency.scale
+    MoneyColumns = ['credit', 'feeAmount', 'balance']
+
+    # binary cache layout, bumped whenever the arrays written by save() change meaning
+    CacheVersion: int = 1
+
+    def __init__(self, size: int = 0):
+
+        self.uniqueId = numpy.zeros(size, dtype=numpy.int64)
+        self.date = numpy.zeros(size, dtype='datetime64[D]')
+
+        self.credit = numpy.zeros(size, dtype=numpy.int64)
+        self.feePercentage = numpy.zeros(size, dtype=numpy.float64)
+        self.feeAmount = numpy.zeros(size, dtype=numpy.int64)
+        self.balance = numpy.zeros(size, dtype=numpy.int64)
+        self.balanceReported = numpy.ones(size, dtype=bool) # False where the balance was filled in (ex: pending rows)
+
+        self.typeCode = numpy.zeros(size, dtype=numpy.int8) # TransactionType values
+        self.transferId = numpy.zeros(size, dtype=numpy.int64) # shared by both rows of a transfer, 0 otherwise (see TransferMatcher)
+
+        # dictionary encoded columns: each code indexes into the matching list of values
+        self.accountCode = numpy.zeros(size, dtype=numpy.int32)
+        self.descriptionCode = numpy.zeros(size, dtype=numpy.int32)
+        self.currencyCode = numpy.zeros(size, dtype=numpy.int32)
+
+        self.accounts: list[str] = []
+        self.descriptions: list[str] = []
+        self.currencies: list[str] = []
+
+        # indexes over the dictionaries, built on first use and shared with every table taken from this one
+        self._indexes: dict[str, object] = {}
+
+    def __len__(self) -> int:
+        return len(self.uniqueId)
+
+    @staticmethod
+    def _encode(values: list) -> tuple[numpy.ndarray, list]:
+
+        index: dict = {}
+        codes = numpy.fromiter((index.setdefault(v, len(index)) for v in values), dtype=numpy.int32, count=len(values))
+
+        return codes, list(index.keys())
+
+    @staticmethod
+    def fromTransactions(transactions: list[Transaction]) -> 'TransactionTable':
+
+        table = TransactionTable(len(transactions))
+        if len(transactions) == 0:
+            return table
+
+        table.uniqueId = numpy.array([t.uniqueId for t in transactions], dtype=numpy.int64)
+        table.date = numpy.array([t.date for t in transactions], dtype='datetime64[D]')
+
+        table.feePercentage = numpy.array([t.feePercentage for t in transactions], dtype=numpy.float64)
+        table.typeCode = numpy.array([t.type.value for t in transactions], dtype=numpy.int8)
+
+        table.accountCode, table.accounts = TransactionTable._encode([t.account for t in transactions])
+        table.descriptionCode, table.descriptions = TransactionTable._encode([t.description for t in transactions])
+        table.currencyCode, table.currencies = TransactionTable._encode([t.currency for t in transactions])
+
+        amounts = {column: numpy.array([t.__getattribute__(column) for t in transactions], dtype=numpy.float64) for column in TransactionTable.MoneyColumns}
+        table._fillMissingAmounts(amounts)
+
+        scales = table.rowScales()
+        for column, values in amounts.items():
+            table.__setattr__(column, TransactionTable.toMinorUnits(values, scales))
+
+        return table
+
+    @staticmethod
+    def fromDataFrame(dataFrame: pandas.DataFrame) -> 'TransactionTable':
+
+        # one typed parse per column, following Schema, instead of probing every value of every row
+        table = TransactionTable(len(dataFrame))
+        amounts: dict[str, numpy.ndarray] = {}
+
+        for field, (dtype, parser) in TransactionTable.Schema.items():
+
+            assert field in dataFrame, f'Attribute {field} not found in data frame'
+
+            values = parser(dataFrame[field])
+            column = TransactionTable.SchemaColumns.get(field, field)
+
+            if dtype is str:
+                codes, uniques = pandas.factorize(values)
+                table.__setattr__(column[0], codes.astype(numpy.int32))
+                table.__setattr__(column[1], list(uniques))
+                continue
+
+            if column in TransactionTable.MoneyColumns:
+                amounts[column] = values # scaled once the currency column is known
+                continue
+
+            table.__setattr__(column, values.astype(dtype, copy=False))
+
+        table._fillMissingAmounts(amounts)
+
+        scales = table.rowScales()
+        for column, values in amounts.items():
+            table.__setattr__(column, TransactionTable.toMinorUnits(values, scales))
+
+        return table
+
+    def _fillMissingAmounts(self, amounts: dict[str, numpy.ndarray]):
+
+        # empty amounts (nan) have no integer form: a missing credit or fee is 0, a missing balance
+        # (ex: revolut pending rows) is the previous reported one in chronological order
+        for column in ['credit', 'feeAmount']:
+
+            missing = numpy.isnan(amounts[column])
+            if missing.any():
+                print(f'[WARN] {missing.sum()} transactions without {column}, counted as 0', file=sys.stderr)
+                amounts[column] = numpy.where(missing, 0., amounts[column])
+
+        balance = amounts['balance']
+        self.balanceReported = ~numpy.isnan(balance)
+        if self.balanceReported.all():
+            return
+
+        order = self.sortOrder(newestFirst=False)
+        chronological = balance[order]
+
+        reported = ~numpy.isnan(chronological)
+        latest = numpy.maximum.accumulate(numpy.where(reported, numpy.arange(len(order)), -1))
+
+        filled = numpy.where(latest >= 0, chronological[numpy.maximum(latest, 0)], 0.)
+        amounts['balance'] = numpy.empty_like(balance)
+        amounts['balance'][order] = filled
+
+    def save(self, path: str):
+
+        # typed arrays as they are in memory, plus what they depend on: the type names behind the codes
+        # and the scale of each currency, so a change to either one is caught on load
+        arrays: dict[str, numpy.ndarray] = {column: self.__getattribute__(column) for column in TransactionTable.ArrayColumns}
+
+        arrays['version'] = numpy.array([TransactionTable.CacheVersion])
+        arrays['accounts'] = numpy.array([str(v) for v in self.accounts], dtype=str)
+        arrays['descriptions'] = numpy.array([str(v) for v in self.descriptions], dtype=str)
+        arrays['currencies'] = numpy.array([str(v) for v in self.currencies], dtype=str)
+        arrays['currencyScales'] = numpy.array([Currency.scale(c) for c in self.currencies], dtype=numpy.int64)
+        arrays['typeNames'] = numpy.array([t.name for t in sorted(TransactionType, key=lambda t: t.value)], dtype=str)
+        arrays['typeValues'] = numpy.array([t.value for t in sorted(TransactionType, key=lambda t: t.value)], dtype=numpy.int64)
+
+        temporaryPath = path + '.tmp.npz' # numpy appends .npz otherwise
+        numpy.savez(temporaryPath, **arrays)
+        os.replace(temporaryPath, path)
+
+    @staticmethod
+    def load(path: str) -> 'TransactionTable':
+
+        with numpy.load(path, allow_pickle=False) as arrays:
+
+            version = int(arrays['version'][0])
+            assert version == TransactionTable.CacheVersion, f'{path}: cache version {version}, expected {TransactionTable.CacheVersion}'
+
+            table = TransactionTable(len(arrays['uniqueId']))
+            for column in TransactionTable.ArrayColumns:
+                if column in arrays: # columns added since keep their defaults
+                    table.__setattr__(column, arrays[column])
+
+            table.accounts = arrays['accounts'].tolist()
+            table.descriptions = arrays['descriptions'].tolist()
+            table.currencies = arrays['currencies'].tolist()
+
+            # type codes through their names, in case TransactionType changed since
+            valueOf = {t.name: t.value for t in TransactionType}
+            remap = numpy.full(int(arrays['typeValues'].max(initial=0)) + 1, TransactionType.other.value, dtype=numpy.int8)
+            for name, value in zip(arrays['typeNames'].tolist(), arrays['typeValues'].tolist()):
+                remap[value] = valueOf.get(name, TransactionType.other.value)
+
+            table.typeCode = remap[table.typeCode]
+            savedScales = arrays['currencyScales']
+
+        # amounts saved in a currency's old minor units
+        scales = numpy.array([Currency.scale(c) for c in table.currencies], dtype=numpy.int64)
+        if not numpy.array_equal(scales, savedScales):
+            factors = (scales / numpy.maximum(savedScales, 1))[table.currencyCode]
+            for column in TransactionTable.MoneyColumns:
+                table.__setattr__(column, TransactionTable.toMinorUnits(table.__getattribute__(column), factors))
+
+        return table
+
+    @staticmethod
+    def concat(tables: list['TransactionTable']) -> 'TransactionTable':
+
+        result = TransactionTable()
+        if len(tables) == 0:
+            return result
+
+        for column in ['uniqueId', 'date', 'credit', 'feePercentage', 'feeAmount', 'balance', 'balanceReported', 'typeCode', 'transferId']:
+            result.__setattr__(column, numpy.concatenate([t.__getattribute__(column) for t in tables]))
+
+        # merge the dictionaries, then remap each table's codes onto the merged one
+        for codeColumn, valuesColumn in [('accountCode', 'accounts'), ('descriptionCode', 'descriptions'), ('currencyCode', 'currencies')]:
+
+            index: dict = {}
+            codes: list[numpy.ndarray] = []
+
+            for t in tables:
+                remap = numpy.array([index.setdefault(v, len(index)) for v in t.__getattribute__(valuesColumn)], dtype=numpy.int32)
+                codes.append(remap[t.__getattribute__(codeColumn)] if len(remap) else t.__getattribute__(codeColumn))
+
+            result.__setattr__(codeColumn, numpy.concatenate(codes))
+            result.__setattr__(valuesColumn, list(index.keys()))
+
+        return result
+
+    def take(self, selection: numpy.ndarray) -> 'TransactionTable':
+        # selection is either a boolean mask or an array of row indices
+
+        result = TransactionTable()
+        for column in TransactionTable.ArrayColumns:
+            result.__setattr__(column, self.__getattribute__(column)[selection])
+
+        result.accounts = self.accounts
+        result.descriptions = self.descriptions
+        result.currencies = self.currencies
+        result._indexes = self._indexes
+
+        return result
+
+    def descriptionIndex(self) -> TrigramIndex:
+
+        if 'description' not in self._indexes:
+            self._indexes['description'] = TrigramIndex(self.descriptions)
+
+        return self._indexes['description']
+
+    def keys(self, occurrences: bool = True) -> numpy.ndarray:
+
+        # stable 64 bit key per row from (uniqueId, date, description), the same in every run unlike hash(),
+        # the amount is left out so a row that changes (pending -> completed) keeps its key
+        if 'descriptionHash' not in self._indexes:
+            self._indexes['descriptionHash'] = numpy.array([
+                int.from_bytes(hashlib.blake2b(str(d).lower().encode(), digest_size=8).digest(), 'little') for d in self.descriptions
+            ], dtype=numpy.uint64)
+
+        keys = self.uniqueId.astype(numpy.uint64) * numpy.uint64(0x9E3779B97F4A7C15)
+        keys ^= self.date.astype(numpy.int64).astype(numpy.uint64) * numpy.uint64(0xBF58476D1CE4E5B9)
+        keys ^= self._indexes['descriptionHash'][self.descriptionCode]
+
+        # distinct rows can share all three (two coffees in the same second on revolut):
+        # the n-th of them, in table order, gets its ordinal mixed in, the first one keeps the plain key
+        if occurrences and len(keys):
+
+            order = numpy.argsort(keys, kind='stable')
+            sortedKeys = keys[order]
+
+            firstOfRun = numpy.flatnonzero(numpy.diff(sortedKeys, prepend=sortedKeys[0] + numpy.uint64(1)))
+            runStart = numpy.repeat(firstOfRun, numpy.diff(numpy.append(firstOfRun, len(keys))))
+
+            ordinals = numpy.empty(len(keys), dtype=numpy.uint64)
+            ordinals[order] = (numpy.arange(len(keys)) - runStart).astype(numpy.uint64)
+
+            keys = keys + ordinals * numpy.uint64(0x94D049BB133111EB)
+
+        return keys.view(numpy.int64)
+
+    def insertPositions(self, other: 'TransactionTable', newestFirst: bool = True) -> numpy.ndarray:
+
+        # where each row of other goes in this sorted table, after the rows with the same date and uniqueId:
+        # one binary search for the block of the same date, one for the uniqueId inside that block
+        dates = self.date[::-1] if newestFirst else self.date
+        positions = numpy.zeros(len(other), dtype=numpy.int64)
+
+        for i, (day, uniqueId) in enumerate(zip(other.date, other.uniqueId)):
+
+            low = numpy.searchsorted(dates, day, side='left')
+            high = numpy.searchsorted(dates, day, side='right')
+
+            if newestFirst:
+                start, end = len(self) - high, len(self) - low
+                positions[i] = end - numpy.searchsorted(self.uniqueId[start:end][::-1], uniqueId, side='left')
+            else:
+                positions[i] = low + numpy.searchsorted(self.uniqueId[low:high], uniqueId, side='right')
+
+        return positions
+
+    def insert(self, positions: numpy.ndarray, other: 'TransactionTable') -> 'TransactionTable':
+
+        # other must already share this table's dictionaries
+        result = TransactionTable()
+        for column in TransactionTable.ArrayColumns:
+            result.__setattr__(column, numpy.insert(self.__getattribute__(column), positions, other.__getattribute__(column)))
+
+        result.accounts = self.accounts
+        result.descriptions = self.descriptions
+        result.currencies = self.currencies
+
+        return result
+
+    def sortOrder(self, newestFirst: bool = True) -> numpy.ndarray:
+
+        # same ordering as Transaction.__lt__ (date, then uniqueId), stable like list.sort
+        days = self.date.astype(numpy.int64)
+
+        if newestFirst:
+            return numpy.lexsort((-self.uniqueId, -days))
+
+        return numpy.lexsort((self.uniqueId, days))
+
+    def sortByDate(self, newestFirst: bool = True) -> 'TransactionTable':
+        return self.take(self.sortOrder(newestFirst))
+
+    def dateSlice(self, dateLowerBound: datetime.date = None, dateUpperBound: datetime.date = None, newestFirst: bool = True) -> slice:
+
+        # rows must already be sorted by date: both bounds (inclusive) are found by binary search,
+        # reversing a newest first table is only a view so this stays O(log n)
+        dates = self.date[::-1] if newestFirst else self.date
+
+        start = numpy.searchsorted(dates, numpy.datetime64(dateLowerBound, 'D'), side='left') if dateLowerBound else 0
+        end = numpy.searchsorted(dates, numpy.datetime64(dateUpperBound, 'D'), side='right') if dateUpperBound else len(dates)
+
+        if newestFirst:
+            return slice(len(dates) - end, len(dates) - start)
+
+        return slice(start, end)
+
+    def withAccountName(self, name: str) -> 'TransactionTable':
+
+        result = self.take(slice(None))
+        result.accountCode = numpy.zeros(len(self), dtype=numpy.int32)
+        result.accounts = [name]
+
+        return result
+
+    @staticmethod
+    def toMinorUnits(amounts: numpy.ndarray, scales: numpy.ndarray) -> numpy.ndarray:
+        # explicit rounding, half to even, to the nearest minor unit
+        minorUnits = numpy.rint(amounts * scales)
+        assert numpy.isfinite(minorUnits).all(), 'amounts must be finite, missing ones are filled before scaling'
+
+        return minorUnits.astype(numpy.int64)
+
+    def rowScales(self) -> numpy.ndarray:
+        return numpy.array([Currency.scale(c) for c in self.currencies], dtype=numpy.int64)[self.currencyCode]
+
+    def convertToCurrency(self, targetCurrency: str):
+
+        if len(self) == 0 or self.currencies == [targetCurrency]:
+            return
+
+        # rate in effect on each row's date, looked up once per currency for all of its rows
+        rowRates = numpy.ones(len(self))
+        for code, currency in enumerate(self.currencies):
+
+            rows = self.currencyCode == code
+            if rows.any():
+                rowRates[rows] = Currency.table().ratesOn(currency, targetCurrency, self.date[rows])
+
+        # minor units of each row's currency to minor units of the target currency
+        rowFactors = rowRates * Currency.scale(targetCurrency) / self.rowScales()
+
+        for column in TransactionTable.MoneyColumns:
+            self.__setattr__(column, TransactionTable.toMinorUnits(self.__getattribute__(column), rowFactors))
+
+        self.currencyCode = numpy.zeros(len(self), dtype=numpy.int32)
+        self.currencies = [targetCurrency]
+
+    def row(self, i: int) -> Transaction:
+        return self.take(slice(i, i + 1)).toTransactions()[0]
+
+    def toTransactions(self) -> list[Transaction]:
+
+        # lightweight row views for existing callers, built column by column
+        scales = self.rowScales()
+
+        columns = zip(
+            [self.accounts[c] for c in self.accountCode.tolist()],
+            self.uniqueId.tolist(),
+            [self.descriptions[c] for c in self.descriptionCode.tolist()],
+            self.date.astype(object).tolist(),
+            self.typeCode.tolist(),
+            (self.credit / scales).tolist(),
+            self.feePercentage.tolist(),
+            (self.feeAmount / scales).tolist(),
+            (self.balance / scales).tolist(),
+            [self.currencies[c] for c in self.currencyCode.tolist()],
+        )
+
+        transactions: list[Transaction] = []
+        for account, uniqueId, description, date, typeCode, credit, feePercentage, feeAmount, balance, currency in columns:
+
+            t = Transaction(currency)
+            t.account = account
+            t.uniqueId = uniqueId
+            t.description = description
+            t.date = date
+            t.type = TransactionType(typeCode)
+            t.credit = credit
+            t.feePercentage = feePercentage
+            t.feeAmount = feeAmount
+            t.balance = balance
+
+            transactions.append(t)
+
+        return transactions
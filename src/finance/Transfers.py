@@ -0,0 +1,116 @@
+import sys
+import numpy
+
+from helpers import withinPercentage
+from finance.Transaction import Transaction, TransactionType
+from finance.TransactionTable import TransactionTable
+
+class TransferMatcher:
+
+    # Money moved between two of our own accounts: a debit in one and a credit in the other,
+    # within maxDays of each other and maxPercentageFee of each other once converted to one currency,
+    # at least one of them categorized as a transfer or described like one
+    def __init__(self, maxPercentageFee: int = 3, maxDays: int = 3, currency: str = 'USD'):
+
+        self.maxPercentageFee: int = maxPercentageFee
+        self.maxDays: int = maxDays
+        self.currency: str = currency
+
+    def match(self, tables: list[TransactionTable]) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+
+        # every row of every table, converted once: (table, row, amount, day)
+        converted = []
+        for t, table in enumerate(tables):
+
+            table = table.take(slice(None)) # conversion replaces the arrays, the account keeps its own
+            table.convertToCurrency(self.currency)
+            converted.append(table)
+
+        tableOf = numpy.concatenate([numpy.full(len(table), t) for t, table in enumerate(converted)] or [[]]).astype(numpy.int64)
+        rowOf = numpy.concatenate([numpy.arange(len(table)) for table in converted] or [[]]).astype(numpy.int64)
+        amounts = numpy.concatenate([table.credit for table in converted] or [[]]).astype(numpy.int64)
+        days = numpy.concatenate([table.date.astype(numpy.int64) for table in converted] or [[]]).astype(numpy.int64)
+
+        # a salary and a rent of about the same amount are not a transfer, one side has to look like one
+        keywords = Transaction.CategoryMap[TransactionType.transfer]
+        transferLike = numpy.concatenate([
+            (table.typeCode == TransactionType.transfer.value) |
+            numpy.array([any(keyword in str(d).lower() for keyword in keywords) for d in table.descriptions] or [False], dtype=bool)[table.descriptionCode]
+            for table in converted
+        ] or [[]]).astype(bool)
+
+        debits = numpy.flatnonzero(amounts < 0)
+        credits = numpy.flatnonzero(amounts > 0)
+
+        # debits sorted by (amount bucket, day), buckets as wide (in log scale) as a credit's tolerance band:
+        # a credit's candidates lie in its own bucket or the two next to it, within maxDays, three binary searches each
+        q = self.maxPercentageFee / 200 # percentageDifference is relative to the average of both amounts
+        bucketWidth = numpy.log((1 + q) / (1 - q))
+        bucketOf = numpy.zeros(len(amounts), dtype=numpy.int64)
+        bucketOf[amounts != 0] = numpy.floor(numpy.log(numpy.abs(amounts[amounts != 0])) / bucketWidth).astype(numpy.int64)
+
+        span = int(days.max() - days.min()) + 2 * self.maxDays + 1 if len(days) else 1
+        position = bucketOf * span + (days - days.min(initial=0))
+
+        def ranges(credits: numpy.ndarray, debits: numpy.ndarray) -> list[tuple[int, numpy.ndarray]]:
+
+            debits = debits[numpy.argsort(position[debits], kind='stable')]
+            debitPositions = position[debits]
+
+            found: list[tuple[int, numpy.ndarray]] = []
+            for offset in [-1, 0, 1]:
+
+                low = numpy.searchsorted(debitPositions, position[credits] + offset * span - self.maxDays, side='left')
+                high = numpy.searchsorted(debitPositions, position[credits] + offset * span + self.maxDays, side='right')
+
+                found += [(credit, debits[start:end]) for credit, start, end in zip(credits.tolist(), low.tolist(), high.tolist()) if end > start]
+
+            return found
+
+        # a salary and a rent of about the same amount are not a transfer: a credit that does not look like one
+        # only meets the debits that do
+        candidates: list[tuple[float, int, int, int]] = []
+        for credit, nearby in ranges(credits[transferLike[credits]], debits) + ranges(credits[~transferLike[credits]], debits[transferLike[debits]]):
+            for debit in nearby.tolist():
+
+                if tableOf[debit] == tableOf[credit]:
+                    continue
+
+                if not withinPercentage(int(-amounts[debit]), int(amounts[credit]), self.maxPercentageFee):
+                    continue
+
+                gap = abs(int(-amounts[debit]) - int(amounts[credit]))
+                candidates.append((gap, abs(int(days[debit] - days[credit])), debit, credit))
+
+        # closest amounts and dates first, every row in at most one pair
+        paired: set[int] = set()
+        pairs: list[tuple[tuple[int, int], tuple[int, int]]] = []
+        for _, _, debit, credit in sorted(candidates):
+
+            if debit in paired or credit in paired:
+                continue
+
+            paired.update([debit, credit])
+            pairs.append(((int(tableOf[debit]), int(rowOf[debit])), (int(tableOf[credit]), int(rowOf[credit]))))
+
+        return pairs
+
+    def tag(self, tables: list[TransactionTable]) -> int:
+
+        # both rows of a pair share the key of their debit row as transferId, so --exclude can drop them
+        # and the pair can be found again, their categories stay as they are; pairs are matched again from scratch
+        for table in tables:
+            table.transferId[:] = 0
+
+        pairs = self.match(tables)
+        keys = [None] * len(tables)
+        for (debitTable, debit), (creditTable, credit) in pairs:
+
+            if keys[debitTable] is None:
+                keys[debitTable] = tables[debitTable].keys()
+
+            tables[debitTable].transferId[debit] = keys[debitTable][debit]
+            tables[creditTable].transferId[credit] = keys[debitTable][debit]
+
+        print(f'Paired {len(pairs)} transfers between accounts.', flush=True, file=sys.stderr)
+        return len(pairs)
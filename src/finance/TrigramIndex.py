@@ -0,0 +1,37 @@
+
+class TrigramIndex:
+
+    # Inverted index from every 3 character sequence to the values containing it,
+    # case insensitive substring searches only verify the candidates shared by all trigrams of the needle
+    def __init__(self, values: list[str]):
+
+        self.values: list[str] = [v.lower() if isinstance(v, str) else None for v in values]
+        self.postings: dict[str, set[int]] = {}
+
+        for i, value in enumerate(self.values):
+
+            if value is None:
+                continue
+
+            for j in range(len(value) - 2):
+                self.postings.setdefault(value[j:j+3], set()).add(i)
+
+    def search(self, needle: str) -> list[int]:
+
+        needle = needle.lower()
+
+        if len(needle) < 3:
+            candidates = range(len(self.values)) # too short to have a trigram, verify everything
+        else:
+            trigrams = {needle[j:j+3] for j in range(len(needle) - 2)}
+            postings = sorted((self.postings.get(t, set()) for t in trigrams), key=len)
+
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+
+                if not candidates:
+                    break
+
+                candidates &= posting
+
+        return sorted(i for i in candidates if self.values[i] is not None and needle in self.values[i])
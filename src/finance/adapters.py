@@ -6,7 +6,7 @@ import pdfplumber
 import pandas
 import datetime
 
-from finance.Transaction import Transaction
+from finance.Transaction import Transaction, Categorizer
 from helpers import parseDate, parseFloat
 
 def transactionsFromBankAudiPDF(pdfPath: str, cacheAfterParsingPath: str = None) -> list[Transaction]:
@@ -72,9 +72,10 @@ def transactionsFromBankAudiPDF(pdfPath: str, cacheAfterParsingPath: str = None)
 
         t.balance = parseFloat(row['Running Balance'])
 
-        t.guessAndFillType()
         transactions.append(t)
 
+    Categorizer.categorize(transactions)
+
     print(f'Parsed {len(transactions)} transactions.', flush=True, file=sys.stderr)
 
     if cacheAfterParsingPath:
@@ -120,10 +121,10 @@ def transactionsFromRevolutCSV(csvFilePath: str) -> list[Transaction]:
         t.feeAmount = parseFloat(row['Fee'])
         t.balance = parseFloat(row['Balance'])
 
-        t.guessAndFillType()
-        t.convertStringAttributes()
-
         transactions.append(t)
 
+    Categorizer.categorize(transactions)
+    [t.convertStringAttributes() for t in transactions]
+
     print(f'Parsed {len(transactions)} transactions.', flush=True, file=sys.stderr)
     return transactions
\ No newline at end of file
@@ -1,6 +1,7 @@
 
 import sys, os
 import argparse
+from datetime import datetime
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 PARENT_DIR = os.path.dirname(CURRENT_DIR)
@@ -8,7 +9,9 @@ sys.path.append(PARENT_DIR)
 
 from GlobalEnv import GlobalEnv
 sys.path.append(GlobalEnv().repoSrcPath)
-from utils.output import printObjectList
+from utils.output import renderObjectList, printRenderedList
+from utils.normalize import normalizationStats
+from finance.ResultCache import ResultCache
 
 if GlobalEnv().accessEncryptedFiles(cmdFallback=True) != 0:
     exit(1)
@@ -17,39 +20,18 @@ ENC_FINANCE_DIR = os.path.join(GlobalEnv().encryptedPath, "finance")
 
 REPORTS_DIR = os.path.join(ENC_FINANCE_DIR, "reports")
 CACHE_DIR = os.path.join(ENC_FINANCE_DIR, "cached")
+RATES_CSV = os.path.join(ENC_FINANCE_DIR, "rates.csv")
+CATEGORIES_CSV = os.path.join(ENC_FINANCE_DIR, "categories.csv")
+RESULTS_DIR = os.path.join(CACHE_DIR, "results")
 
-from datetime import datetime
-import pandas
-
-from finance.Transaction import Transaction, TransactionFilter, TransactionType, Currency
-from finance.Account import Account, cacheAccount
-from finance.Portfolio import Portfolio
-from finance.adapters import transactionsFromBankAudiPDF, transactionsFromRevolutCSV
-
-def transactionsFromCachedCsv(csvFilePath: str) -> list[Transaction]:
-
-    dataFrame: pandas.DataFrame = pandas.read_csv(csvFilePath)
-    transactions: list[Transaction] = []
-    
-    print(f'Parsing from dataframe {csvFilePath}...', end=' ', flush=True, file=sys.stderr)
-
-    for _, row in dataFrame.iterrows():
-        t = Transaction.fromDataFrameRow(row)
-        transactions.append(t)
-
-    print(f'{len(transactions)} transactions)', flush=True, file=sys.stderr)
-    return transactions
-
-def getLatestCachedCsvFile() -> str:
-    return os.path.join(REPORTS_DIR, 'cached.csv')
-
-if __name__ == '__main__':
+def parseArguments() -> argparse.Namespace:
 
     parser = argparse.ArgumentParser(description='Parse an account activity report from Bank Audi')
     parser.add_argument('--csv', action='store_true', default=False, help='Output in csv format')
 
     limitArg = parser.add_argument_group()
     limitArg.add_argument('--all', action='store_true', help='Show all transactions, overrides --limit', default=False)
+    limitArg.add_argument('-n', '--limit', type=int, help='--limit=N: only show the N newest transactions (default: 20 in a terminal without filters)', default=None)
 
     fileType = parser.add_mutually_exclusive_group()
     fileType.add_argument('--refresh', action='store_true', help='Parse and cache "./Reports/audi.pdf"')
@@ -59,17 +41,158 @@ if __name__ == '__main__':
     filterArg.add_argument('-a', '--account', type=str, help='--account=X: only transactions for account X')
     filterArg.add_argument('-d', '--desc', type=str, help='--desc=X: only transactions with "X" in the description')
     filterArg.add_argument('-t', '--type', type=str, help='--type=X: only transactions of type X')
-    filterArg.add_argument('-x', '--exclude', type=str, help='--exclude=X (regex): exclude transactions matching X in the description OR category OR account name')
+    filterArg.add_argument('-x', '--exclude', type=str, help='--exclude=X (regex): exclude transactions matching X in the description OR category OR account name ("transfer" also matches transfers paired between accounts)')
 
     # Date filters
     filterArg.add_argument('--after', type=str, help='--after=dd-mm-yyyy: only transactions after this date', default=None)
     filterArg.add_argument('--before', type=str, help='--before=dd-mm-yyyy: only transactions before this date', default=None)
 
+    # Aggregation
+    parser.add_argument('-s', '--summary', type=str, help='--summary=month,type: totals, counts, means and fees grouped by any of month, type, account, currency', default=None)
+
+    parser.add_argument('--networth', type=str, nargs='?', const='', help='Daily balance per account and in total, or --networth=dd-mm-yyyy for a single day (only --account, --after and --before apply)', default=None)
+    parser.add_argument('--anomalies', type=int, nargs='?', const=0, help='Transactions with an unusual amount for their merchant or type, --anomalies=N: compared to the last N days only', default=None)
+    parser.add_argument('--subscriptions', action='store_true', help='Show active recurring charges with their period and next expected date', default=False)
+
     # Currency
     parser.add_argument('-c', '--currency', type=str, help='Example: --currency=EUR, convert all transactions to this currency', default='USD')
 
     args = parser.parse_args()
 
+    # balances are per account and day, there is no transaction left for these to filter out
+    if args.networth is not None and (args.desc or args.type or args.exclude):
+        parser.error('--networth only applies --account, --after and --before, not --desc, --type or --exclude')
+
+    return args
+
+def normalizedQuery(args: argparse.Namespace) -> dict:
+
+    # every argument that changes the output, in one canonical form (filters are case insensitive)
+    query = dict(vars(args))
+    query.pop('refresh')
+
+    for arg in ['account', 'desc', 'exclude']:
+        query[arg] = query[arg].lower() if query[arg] else None
+
+    for arg in ['after', 'before']:
+        query[arg] = datetime.strptime(query[arg], "%d-%m-%Y").date().isoformat() if query[arg] else None
+
+    if query['summary']:
+        query['summary'] = [key.strip() for key in query['summary'].split(',')]
+
+    query['piped'] = not sys.stdout.isatty() # changes the default limit
+    return query
+
+def resultCacheOf(args: argparse.Namespace) -> ResultCache:
+
+    # same query on the same cached files, rates, categories and code: reuse the previous result
+    inputFiles = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR)] if os.path.isdir(CACHE_DIR) else []
+    inputFiles += [RATES_CSV, CATEGORIES_CSV]
+    inputFiles += [os.path.join(directory, name) for directory in [CURRENT_DIR, os.path.join(PARENT_DIR, 'utils')] for name in os.listdir(directory) if name.endswith('.py')]
+
+    return ResultCache(RESULTS_DIR, normalizedQuery(args), inputFiles)
+
+def printRendered(rendered: tuple[str, str, str], csv: bool):
+
+    headerContent, tableContent, note = rendered
+
+    printRenderedList(headerContent, tableContent, csv)
+    if note:
+        print(note, file=sys.stderr)
+
+# a repeated query is answered from the result cache here, before the heavy imports below (pandas, numpy, pdf parsing)
+if __name__ == '__main__':
+
+    args = parseArguments()
+    resultCache = resultCacheOf(args)
+
+    if args.refresh:
+        resultCache.clear()
+
+    cachedResult = resultCache.get()
+    if cachedResult is not None:
+        printRendered(cachedResult, args.csv)
+        exit(0)
+
+import pandas
+import functools
+
+from finance.Transaction import Transaction, TransactionFilter, TransactionType, Currency, Categorizer
+from finance.Account import Account, cacheAccount
+from finance.TransactionTable import TransactionTable
+from finance.Portfolio import Portfolio
+from finance.Summary import Summary
+from finance.Subscriptions import Subscriptions
+from finance.Transfers import TransferMatcher
+from finance.Anomalies import Anomalies
+from finance.Ingestion import AccountSource, Job, runConcurrently
+from finance.adapters import transactionsFromBankAudiPDF, transactionsFromRevolutCSV
+
+# one entry per account, refreshed and loaded concurrently in this order
+ACCOUNT_SOURCES: list[AccountSource] = [
+    AccountSource('Bank Audi', 'USD', 'bank_audi.npz', 'audi.pdf',
+                  functools.partial(transactionsFromBankAudiPDF, cacheAfterParsingPath=os.path.join(REPORTS_DIR, 'audi_copy.pdf')),
+                  cpuBound=True, normalizeFees=True),
+    AccountSource('Revolut EUR', 'EUR', 'revolut_eur.npz', 'revolut_eur.csv', transactionsFromRevolutCSV, separateFees=True),
+]
+
+def transactionsFromCachedCsv(csvFilePath: str) -> TransactionTable:
+
+    # typed columns straight from the cache, types were already guessed before caching
+    table = TransactionTable.fromDataFrame(pandas.read_csv(csvFilePath))
+    Categorizer.applyOverrides(table)
+
+    # one write per line, other accounts load at the same time
+    print(f'Parsed from dataframe {csvFilePath} ({len(table)} transactions)\n', end='', flush=True, file=sys.stderr)
+    return table
+
+def transactionsFromCache(cachePath: str) -> TransactionTable:
+
+    # typed arrays as saved, no parsing
+    table = TransactionTable.load(cachePath)
+    Categorizer.applyOverrides(table)
+
+    print(f'Loaded {cachePath} ({len(table)} transactions)\n', end='', flush=True, file=sys.stderr)
+    return table
+
+def cachedAccount(name: str, currency: str, fileName: str) -> Account:
+
+    cachePath = os.path.join(CACHE_DIR, fileName)
+
+    # one time migration from the csv cache, renamed once migrated so it cannot come back
+    # as the history if the binary cache goes missing later
+    csvFilePath = os.path.splitext(cachePath)[0] + '.csv'
+    if not os.path.exists(cachePath) and os.path.exists(csvFilePath):
+
+        transactionsFromCachedCsv(csvFilePath).save(cachePath)
+        os.replace(csvFilePath, csvFilePath + '.migrated')
+        print(f'Migrated {csvFilePath} to {cachePath}\n', end='', flush=True, file=sys.stderr)
+
+    if not os.path.exists(cachePath):
+        return Account(name, currency, [])
+
+    return Account(name, currency, transactionsFromCache(cachePath))
+
+def respond(resultCache: ResultCache, rows: list[object], csv: bool, note: str = None):
+
+    # the rendered text is what gets cached, a repeat query skips tabulating too
+    rendered = (*renderObjectList(rows, csv), note)
+    resultCache.put(rendered)
+
+    printRendered(rendered, csv)
+    exit(0)
+
+def getLatestCachedCsvFile() -> str:
+    return os.path.join(REPORTS_DIR, 'cached.csv')
+
+if __name__ == '__main__':
+
+    if os.path.exists(RATES_CSV):
+        Currency.loadRateHistory(RATES_CSV)
+
+    if os.path.exists(CATEGORIES_CSV):
+        Categorizer.loadMemo(CATEGORIES_CSV)
+
     transactions: list[Transaction] = []
     portfolio: Portfolio = None
 
@@ -80,24 +203,62 @@ if __name__ == '__main__':
             print(f'Looks like there is nothing to refresh from.\nMake sure {audiPdf} exists and is not empty.', file=sys.stderr)
             exit(1)
 
-        bankAudi = Account('Bank Audi', 'USD', transactionsFromBankAudiPDF(audiPdf, cacheAfterParsingPath=os.path.join(REPORTS_DIR, 'audi_copy.pdf')))
-        bankAudi.normalizeTransactionsWithFees()
-        revolutEur = Account('Revolut EUR', 'EUR', transactionsFromRevolutCSV(os.path.join(REPORTS_DIR, 'revolut_eur.csv')))
+        # statements are parsed (pdfs in other processes) while the cached histories load
+        results = runConcurrently(
+            [Job(source.name, source.parse, (os.path.join(REPORTS_DIR, source.statementFile),), source.cpuBound) for source in ACCOUNT_SOURCES] +
+            [Job(source.name, cachedAccount, (source.name, source.currency, source.cacheFile)) for source in ACCOUNT_SOURCES]
+        )
+        statements, cachedAccounts = results[:len(ACCOUNT_SOURCES)], results[len(ACCOUNT_SOURCES):]
+
+        loaded: list[tuple[AccountSource, Account]] = []
+        for source, statement, account in zip(ACCOUNT_SOURCES, statements, cachedAccounts):
+
+            if account is None: # unreadable cache, left untouched rather than overwritten with the statement alone
+                continue
+
+            # new statements are merged into the cached history instead of replacing it
+            if statement is not None:
+
+                if source.cpuBound: # parsed in a worker process, categorized there with that process's own memo
+                    Categorizer.categorize(statement)
+
+                statementAccount = Account(source.name, source.currency, statement)
+
+                # checked as the bank reported it: normalization drops debits together with their refunds,
+                # which the reported balances still include
+                reconciliation = statementAccount.reconcile(source.separateFees)
+                if not reconciliation.ok():
+                    print(f'[WARN] Balances do not reconcile for {reconciliation.report()}', file=sys.stderr)
+
+                if source.normalizeFees:
+                    statementAccount.normalizeTransactionsWithFees()
+
+                account.merge(statementAccount.table)
+
+            loaded.append((source, account))
+
+        # top-ups show up on both sides, pair them once here so the cache keeps the pairs
+        TransferMatcher().tag([account.table for _, account in loaded])
 
-        cacheAccount(bankAudi)
-        cacheAccount(revolutEur)
+        runConcurrently([Job(source.name, cacheAccount, (account,)) for source, account in loaded])
+        Categorizer.saveMemo(CATEGORIES_CSV)
 
         today: str = datetime.now().strftime('%Y-%m-%d')
         GlobalEnv().updateEncryptedFiles(f'update finance transactions as of {today}', cmdFallback=True)
 
-    else: # if not refreshing, read from cached csv
+    else: # if not refreshing, read from the binary caches
         
-        bankAudi = Account('Bank Audi', 'USD', transactionsFromCachedCsv(os.path.join(CACHE_DIR, 'bank_audi.csv')))
-        revolutEur = Account('Revolut EUR', 'EUR', transactionsFromCachedCsv(os.path.join(CACHE_DIR, 'revolut_eur.csv')))
+        accounts = runConcurrently([Job(source.name, cachedAccount, (source.name, source.currency, source.cacheFile)) for source in ACCOUNT_SOURCES])
+        loaded = [(source, account) for source, account in zip(ACCOUNT_SOURCES, accounts) if account is not None]
 
-    portfolio = Portfolio('USD')
-    portfolio.withAccount(bankAudi)
-    portfolio.withAccount(revolutEur)
+    if GlobalEnv().loggingEnabled:
+        print(f'[INFO] Description normalization: {normalizationStats()}', file=sys.stderr)
+
+    assert Currency.currencySupported(args.currency), f'Currency not supported: {args.currency}'
+
+    portfolio = Portfolio(args.currency)
+    for _, account in loaded:
+        portfolio.withAccount(account)
 
     filter: TransactionFilter = TransactionFilter()
     filter.account = args.account
@@ -114,15 +275,6 @@ if __name__ == '__main__':
 
     portfolio.withFilter(filter)
 
-    portfolioAccount: Account = portfolio.build()
-
-    assert Currency.currencySupported(args.currency), f'Currency not supported: {args.currency}'
-    portfolioAccount.convertToCurrency(args.currency)
-
-    if not args.csv:
-        portfolioAccount.addTotal()
-        [t.prepareForPrettyPrint() for t in portfolioAccount.transactions]
-
     pipedOutput = bool(not sys.stdout.isatty())
     filterApplied = any(filter.__dict__.values())
 
@@ -132,10 +284,46 @@ if __name__ == '__main__':
     fullOutput |= args.all
     fullOutput |= args.csv
 
-    if fullOutput:
-        printObjectList(portfolioAccount.transactions, args.csv)
-        exit(0)
+    # newest rows first, like the listing: 20 by default in a terminal without filters
+    limit: int = None if args.all else (args.limit if args.limit is not None else (None if fullOutput else 20))
+
+    if args.networth is not None:
+
+        day = datetime.strptime(args.networth, "%d-%m-%Y").date() if args.networth else None
+        rows = portfolio.netWorth(day)
+
+        truncated: bool = limit is not None and len(rows) > limit
+        respond(resultCache, rows[:limit], args.csv, f'\n...<only showing {limit}>' if truncated else None)
+
+    # the listing only produces the rows it prints, the aggregations need every matching row
+    if not (args.summary or args.subscriptions or args.anomalies is not None):
+
+        portfolio.withLimit(limit)
+
+    portfolioAccount: Account = portfolio.build()
+
+    if args.summary:
+
+        accountCurrencies = {account.name: account.currency for account in portfolio.accounts}
+        summary = Summary(portfolioAccount.table, portfolioAccount.currency, [key.strip() for key in args.summary.split(',')], accountCurrencies)
+        respond(resultCache, summary.rows(), args.csv)
+
+    if args.anomalies is not None:
+
+        respond(resultCache, Anomalies(portfolioAccount.table, portfolioAccount.currency, args.anomalies).anomalies, args.csv)
+
+    if args.subscriptions:
+
+        respond(resultCache, Subscriptions(portfolioAccount.table, portfolioAccount.currency).subscriptions, args.csv)
+
+    transactions = portfolioAccount.transactions
+    truncated: bool = portfolio.matched > len(transactions)
+
+    if not args.csv and len(transactions):
+
+        if not truncated: # a total of the shown rows only would be misleading
+            transactions.append(portfolioAccount.getTotal())
+
+        [t.prepareForPrettyPrint() for t in transactions]
 
-    printObjectList(portfolioAccount.transactions[:20], csv=False)
-    print(f'\n...<only showing 20>', file=sys.stderr)
-    exit(0)
\ No newline at end of file
+    respond(resultCache, transactions, args.csv, f'\n...<only showing {len(transactions)}>' if truncated else None)
\ No newline at end of file
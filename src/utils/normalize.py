@@ -0,0 +1,61 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+# bank noise removed from descriptions (branch codes, card numbers, standalone numbers...)
+_NoisePatterns: list[re.Pattern] = [re.compile(p, re.IGNORECASE) for p in ['branch', 'pos', 'prch', 'cash', 'onsite', 'offsite', 'mpfx', r'm\S*8831\S*', r'[^\w]{2,}', '^-', r'\b\d+\b']]
+_Spaces: re.Pattern = re.compile(r'\s+')
+_SpecialChar: re.Pattern = re.compile(r'[^a-zA-Z0-9]')
+
+class NormalizedText:
+
+    def __init__(self, raw: str):
+
+        self.raw: str = raw
+
+        # cleaned description, as shown to the user
+        self.clean: str = _clean(raw)
+        self.lower: str = self.clean.lower()
+
+        # comparison forms of the raw text, used by compareStrings
+        self.folded: str = raw.strip().lower()
+        self.words: str = _Spaces.sub(' ', _SpecialChar.sub(' ', self.folded))
+        self.tokens: frozenset[str] = frozenset(self.words.split())
+
+def _removeAccents(inputStr: str) -> str:
+    return ''.join(
+        c for c in unicodedata.normalize('NFD', inputStr) if unicodedata.category(c) != 'Mn'
+    )
+
+def _cleanOnce(text: str) -> str:
+
+    for pattern in _NoisePatterns:
+        text = pattern.sub(' ', text)
+
+    text = _Spaces.sub(' ', text).strip()
+    text = _removeAccents(text)
+
+    # capitalize first letter of each word, lowercase the rest
+    return ' '.join(word.capitalize() for word in text.split())
+
+def _clean(text: str) -> str:
+
+    # removing accents can reveal more noise ("Pós" -> "Pos"), clean until stable
+    for _ in range(4):
+
+        cleaned = _cleanOnce(text)
+        if cleaned == text:
+            break
+
+        text = cleaned
+
+    return text
+
+@lru_cache(maxsize=1 << 16)
+def normalize(raw: str) -> NormalizedText:
+    return NormalizedText(raw)
+
+def normalizationStats() -> str:
+
+    info = normalize.cache_info()
+    return f'{info.hits} hits, {info.misses} misses, {info.currsize} cached'
@@ -4,12 +4,11 @@ import sys
 import time
 from tabulate import tabulate
 
-def printObjectList(objects: list[object], csv: bool = False):
+def renderObjectList(objects: list[object], csv: bool = False) -> tuple[str, str]:
 
+    # (headers, rows) as printed by printObjectList
     if len(objects) == 0:
-        return
-
-    print(end='\n', flush=True, file=sys.stderr)
+        return '', ''
 
     tableContent = [obj.__dict__.values() for obj in objects]
     headers = [key.capitalize() for key in objects[0].__dict__.keys()]
@@ -24,6 +23,15 @@ def printObjectList(objects: list[object], csv: bool = False):
     headerContent = '\n'.join(fullTable.split('\n')[:headerCutOff])
     tableContent = '\n'.join(fullTable.split('\n')[headerCutOff:])
 
+    return headerContent, tableContent
+
+def printRenderedList(headerContent: str, tableContent: str, csv: bool = False):
+
+    if not len(headerContent):
+        return
+
+    print(end='\n', flush=True, file=sys.stderr)
+
     if not len(tableContent):
         return
 
@@ -37,4 +45,7 @@ def printObjectList(objects: list[object], csv: bool = False):
     try:
         print(tableContent, file=sys.stdout)
     except BrokenPipeError: # some commands like "head" will close the pipe early and prevent the program from outputting more lines
-        pass
\ No newline at end of file
+        pass
+
+def printObjectList(objects: list[object], csv: bool = False):
+    printRenderedList(*renderObjectList(objects, csv), csv)
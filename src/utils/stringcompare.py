@@ -1,35 +1,23 @@
-
-import re
+from utils.normalize import normalize
 
 # Compare 2 strings and return a similarity score /100
 def compareStrings(left: str, right: str) -> int:
 
-    specialChar = re.compile(r"[^a-zA-Z0-9]")
-    spaces = re.compile(r"\s+")
-
     if left == right:
         return 100
 
-    left = left.strip().lower()
-    right = right.strip().lower()
+    # normalized forms are cached, repeated descriptions are only tokenized once
+    left = normalize(left)
+    right = normalize(right)
 
-    if left == right:
+    if left.folded == right.folded:
         return 98
 
-    left = re.sub(specialChar, " ", left)
-    left = re.sub(spaces, " ", left)
-
-    right = re.sub(specialChar, " ", right)
-    right = re.sub(spaces, " ", right)
-
-    if left == right:
+    if left.words == right.words:
         return 95
 
-    lWords = set(left.split())
-    rWords = set(right.split())
-
-    wordsInCommon = lWords & rWords
-    totalWords = lWords | rWords
+    wordsInCommon = left.tokens & right.tokens
+    totalWords = left.tokens | right.tokens
 
     similarity = len(wordsInCommon) / len(totalWords)
     return int(similarity * 100)